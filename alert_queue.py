@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+
+
+class AlertDispatcher:
+    """
+    Runs alert deliveries on a pool of worker threads, separate from the analysis loop.
+
+    At most max_workers alerts run at once and at most max_pending more wait in the queue;
+    submit() blocks once the queue is full, so a burst of trending videos slows the
+    analysis down instead of piling up rendered charts in memory.
+    """
+
+    def __init__(self, deliver, max_workers=8, max_pending=32, timeout=None, stats=None):
+        self.deliver = deliver
+        self.timeout = timeout
+        # Live counters of alerts_queued/alerts_sent/alerts_failed, readable while the run is going
+        self.stats = stats if stats is not None else {}
+        for key in ('alerts_queued', 'alerts_sent', 'alerts_failed'):
+            self.stats.setdefault(key, 0)
+        self._stats_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='alert')
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._futures = {}
+
+    def submit(self, *args):
+        self._slots.acquire()
+        future = self._executor.submit(self._run, args)
+        self._futures[future] = args
+        self._count('alerts_queued')
+        return future
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _run(self, args):
+        sent = False
+        try:
+            sent = self.deliver(*args)
+            return sent
+        finally:
+            self._count('alerts_sent' if sent else 'alerts_failed')
+            self._slots.release()
+
+    def close(self):
+        # Wait for every queued alert, up to `timeout` seconds in total. Alerts still queued
+        # then are cancelled, but the ones already delivering are waited for, since they
+        # may reach Slack and must then be reported as sent rather than retried.
+        # Returns a dict with the args of the alerts that were sent, failed or never started.
+        results = {'sent': [], 'failed': [], 'timed_out': []}
+        try:
+            for _ in as_completed(self._futures, timeout=self.timeout):
+                pass
+        except TimeoutError:
+            cancelled = sum(future.cancel() for future in self._futures)
+            print(f"{cancelled} alerts did not start within {self.timeout} seconds and were cancelled; "
+                  f"waiting for the ones already running.")
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for future, args in self._futures.items():
+            if future.cancelled():
+                results['timed_out'].append(args)
+                continue
+            try:
+                results['sent' if future.result() else 'failed'].append(args)
+            except Exception as e:
+                print(f"An error occurred while delivering an alert: {e}")
+                results['failed'].append(args)
+        self._futures = {}
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
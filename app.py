@@ -3,8 +3,10 @@ import json
 import logging
 import os
 from slack_sdk import WebClient
-import psycopg2
-from main import fetch_moving_averages, analyze_videos
+from concurrent.futures import ThreadPoolExecutor
+from comments import cached_top_comments, enable_alert_warming, get_top_comments
+from jobs import JobRunner, PostgresJobStore
+from metrics import metrics
 
 app = Flask(__name__)
 
@@ -15,14 +17,15 @@ SLACK_BOT_TOKEN = os.getenv('SLACK_BOT_TOKEN')
 
 slack_client = WebClient(token=SLACK_BOT_TOKEN)
 
+# Analysis runs happen in the background so requests return straight away; job state is
+# shared with the other gunicorn workers through the pipeline_jobs table
+job_runner = JobRunner(store=PostgresJobStore())
 
-db_params = {
-    'database': os.environ.get('DB_NAME'),
-    'user': os.environ.get('DB_USER'),
-    'password': os.environ.get('DB_PASS'),
-    'host': os.environ.get('DB_HOST'),
-    'port': os.environ.get('DB_PORT')
-}
+# Alerts sent by this worker's jobs pre-warm its comments cache for the "View Details" click
+enable_alert_warming()
+
+# Slack modals are built off the request thread
+modal_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='slack-modal')
 
 @app.route('/slack/interactivity-endpoint', methods=['POST'])
 def interactivity_endpoint():
@@ -36,129 +39,170 @@ def interactivity_endpoint():
     return jsonify({})
 
 
+def request_events():
+    # The metrics http sink posts a batch (a JSON list); older clients post a single object
+    data = request.json
+    return data if isinstance(data, list) else [data]
+
+
 @app.route('/error-logging', methods=['POST'])
 def error_logging():
-    error_data = request.json  # Assuming error details are sent as a JSON payload
-    logging.error(f"Error logged: {error_data}")
+    errors = request_events()  # Error details sent as a JSON payload
+    for error_data in errors:
+        logging.error(f"Error logged: {error_data}")
+    metrics.increment('errors_received', len(errors))
     # Here, you could add the error to a monitoring system or a database
-    return jsonify({'status': 'Error Received'})
+    return jsonify({'status': 'Error Received', 'received': len(errors)})
 
 @app.route('/alert-sent', methods=['POST'])
 def alert_sent():
-    # This is a simple logging endpoint for when main.py sends an alert
-    data = request.json  # Assuming main.py sends a JSON payload
-    logging.info(f"Alert sent: {data}")
-    return jsonify({'status': 'Received'})
-
-
-
-def get_top_comments(video_url):
-    # Execute SQL query to fetch top 5 comments for the given video URL
-    conn = psycopg2.connect(**db_params)
-    cursor = conn.cursor()
-    query = f"""
-    SELECT * 
-    FROM comments 
-    WHERE video_url = '{video_url}'
-    ORDER BY likes DESC
-    LIMIT 5;
-    """
-    cursor.execute(query)
-    results = cursor.fetchall()    
-    return results
+    # This is a simple logging endpoint for when main.py sends alerts
+    alerts = request_events()
+    for data in alerts:
+        logging.info(f"Alert sent: {data}")
+    metrics.increment('alerts_received', len(alerts))
+    return jsonify({'status': 'Received', 'received': len(alerts)})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Counters and per-stage timing histograms of every process that published them:
+    # the gunicorn workers, including the runs they started, and main.py CLI and sharded runs
+    return jsonify(metrics.shared_snapshot())
+
+
 
 @app.route('/slack/actions', methods=['POST'])
 def slack_actions():
+    # Acknowledge straight away; Slack gives us 3 seconds. The modal is built and opened in the background.
     try:
         payload = json.loads(request.form.get('payload'))
+    except (TypeError, ValueError) as e:
+        logging.error(f"Invalid Slack action payload: {e}")
+        return "Bad Request", 400
+    modal_executor.submit(open_details_modal, payload)
+    return "", 200
+
+
+def open_details_modal(payload):
+    try:
         video_link = payload['original_message']['attachments'][1]['title_link']
-        youtube_thumbnail = f"https://img.youtube.com/vi/{get_video_id(video_link)}/0.jpg"
         additional_image = payload['original_message']['attachments'][1]['image_url']
-        comments = get_top_comments(video_link)
 
-        # Create a list to store blocks for the modal
-        modal_blocks = [
-            {
-                "type": "image",
-                "title": {
-                    "type": "plain_text",
-                    "text": "YouTube Video"
-                },
-                "image_url": youtube_thumbnail,
-                "alt_text": "YouTube Video"
-            },
+        comments = cached_top_comments(video_link)
+        if comments is not None:
+            # Comments were pre-warmed when the alert was sent, so the full modal can open at once
+            response = slack_client.views_open(
+                trigger_id=payload['trigger_id'],
+                view=build_details_view(video_link, additional_image, comments)
+            )
+        else:
+            # Open a placeholder while trigger_id is still valid, then fill it in
+            response = slack_client.views_open(trigger_id=payload['trigger_id'], view=build_loading_view())
+            if response["ok"]:
+                comments = get_top_comments(video_link)
+                response = slack_client.views_update(
+                    view_id=response['view']['id'],
+                    hash=response['view']['hash'],
+                    view=build_details_view(video_link, additional_image, comments)
+                )
+
+        if not response["ok"]:
+            raise ValueError(f"Failed to open modal: {response['error']}")
+    except Exception as e:
+        logging.error(f"Error while opening the details modal: {e}")
+
+
+def build_loading_view():
+    return {
+        "type": "modal",
+        "title": {
+            "type": "plain_text",
+            "text": "Details"
+        },
+        "blocks": [
             {
-                "type": "context",
-                "elements": [
-                    {
-                        "type": "mrkdwn",
-                        "text": f"<{video_link}|Watch on YouTube>"
-                    }
-                ]
+                "type": "section",
+                "text": {"type": "mrkdwn", "text": "Loading video details..."}
             }
         ]
+    }
+
 
-        # Add the image section before the comments
-        image_section = {
+def build_details_view(video_link, additional_image, comments):
+    youtube_thumbnail = f"https://img.youtube.com/vi/{get_video_id(video_link)}/0.jpg"
+
+    # Create a list to store blocks for the modal
+    modal_blocks = [
+        {
             "type": "image",
             "title": {
                 "type": "plain_text",
-                "text": "Chart"
+                "text": "YouTube Video"
             },
-            "image_url": additional_image,
-            "alt_text": ""
+            "image_url": youtube_thumbnail,
+            "alt_text": "YouTube Video"
+        },
+        {
+            "type": "context",
+            "elements": [
+                {
+                    "type": "mrkdwn",
+                    "text": f"<{video_link}|Watch on YouTube>"
+                }
+            ]
         }
-        modal_blocks.append(image_section)
-
-        # Add comments section after the image
-        # Create a header row for the table
-        table_header = {
+    ]
+
+    # Add the image section before the comments
+    image_section = {
+        "type": "image",
+        "title": {
+            "type": "plain_text",
+            "text": "Chart"
+        },
+        "image_url": additional_image,
+        "alt_text": ""
+    }
+    modal_blocks.append(image_section)
+
+    # Add comments section after the image
+    # Create a header row for the table
+    table_header = {
+        "type": "section",
+        "fields": [
+            {"type": "mrkdwn", "text": "*COMMENTS*"},
+            {"type": "mrkdwn", "text": "*LIKES*"},
+        ]
+    }
+    modal_blocks.append(table_header)
+
+    # Add divider after the headings
+    divider_block = {"type": "divider"}
+    modal_blocks.append(divider_block)
+
+    # Add comments as rows in the table with numbering
+    for index, comment in enumerate(comments, start=1):
+        comment_text = comment[3]
+        likes = comment[5]
+        comment_row = {
             "type": "section",
             "fields": [
-                {"type": "mrkdwn", "text": "*COMMENTS*"},
-                {"type": "mrkdwn", "text": "*LIKES*"},
+                {"type": "mrkdwn", "text": f"{index}. {comment_text}"},
+                {"type": "mrkdwn", "text": str(likes)},
             ]
         }
-        modal_blocks.append(table_header)
+        modal_blocks.append(comment_row)
 
-        # Add divider after the headings
-        divider_block = {"type": "divider"}
-        modal_blocks.append(divider_block)
-
-        # Add comments as rows in the table with numbering
-        for index, comment in enumerate(comments, start=1):
-            comment_text = comment[3]
-            likes = comment[5]
-            comment_row = {
-                "type": "section",
-                "fields": [
-                    {"type": "mrkdwn", "text": f"{index}. {comment_text}"},
-                    {"type": "mrkdwn", "text": str(likes)},
-                ]
-            }
-            modal_blocks.append(comment_row)
-        response = slack_client.views_open(
-            trigger_id=payload['trigger_id'],
-            view={
-                "type": "modal",
-                "title": {
-                    "type": "plain_text",
-                    "text": "Details"
-                },
-                "blocks": modal_blocks,
-                "private_metadata": "abc123"  # Add private_metadata as needed
-            },
-            hash="modal_css",  # Specify an identifier for CSS
-            css="div.p-modal__content { max-width: 800px !important; }"  # Define CSS styles for the modal
-        )
-
-        if not response["ok"]:
-            raise ValueError(f"Failed to open modal: {response['error']}")
-
-        return "", 200
-    except Exception as e:
-        print(e)
-        return "Internal Server Error", 500
+    return {
+        "type": "modal",
+        "title": {
+            "type": "plain_text",
+            "text": "Details"
+        },
+        "blocks": modal_blocks,
+        "private_metadata": "abc123"  # Add private_metadata as needed
+    }
 
 
 
@@ -172,13 +216,35 @@ def get_video_id(video_link):
 
 @app.route('/slack/notifications', methods=['GET'])
 def send_notifications():
-    df_moving_averages = fetch_moving_averages()
-    if df_moving_averages is not None and not df_moving_averages.empty:
-        analyze_videos(df_moving_averages)
-        return jsonify({'status': 'Notification sent'})
-
-    else:
-        return jsonify({'status': 'No moving averages found to analyze'})
+    # Queue an analysis run and return its job id without waiting for it.
+    # ?mode=incremental only analyzes videos with statistics newer than the previous incremental run.
+    # ?source=window reads the precomputed per-video recent window table, after recomputing
+    # every video's window with &rebuild=1 (e.g. after back-filling older dates),
+    # ?source=pushdown evaluates the trend rule in Postgres and only fetches the candidates.
+    mode = 'incremental' if request.args.get('mode') == 'incremental' else 'full'
+    source = request.args.get('source') if request.args.get('source') in ('window', 'pushdown') else 'statistics'
+    rebuild_window = source == 'window' and request.args.get('rebuild') == '1'
+    job, merged = job_runner.trigger(mode, lambda progress: run_notifications(mode, source, progress, rebuild_window),
+                                     {})
+    status = 'Run already in progress' if merged else 'Run queued'
+    return jsonify({'status': status, 'job_id': job['id'], 'merged': merged}), 202
+
+
+def run_notifications(mode, source, progress, rebuild_window=False):
+    # main pulls in pandas, numpy and the pipeline; import it on the job thread,
+    # not at worker boot or on the request thread
+    from main import new_progress, run_pipeline
+    progress.update(new_progress())
+    run_pipeline(mode, progress, source=source, rebuild_window=rebuild_window)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    # Progress (videos scanned, trending found, alerts sent) and timing of a run
+    job = job_runner.get(job_id)
+    if job is None:
+        return jsonify({'status': 'Unknown job'}), 404
+    return jsonify(job)
 
 if __name__ == '__main__':
     app.run(debug=True, port=8080)
\ No newline at end of file
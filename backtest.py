@@ -0,0 +1,229 @@
+"""
+Historical backtest of the trend rule, for tuning the threshold and the window.
+
+Replays the alerting pipeline on every past date at once: the is_trending rule is
+evaluated for every video on every day it has statistics, for each combination of
+threshold and window, and the new/up/down alert logic is replayed over the days a
+video trended. Reports per day and setting how many videos trended, entered and left
+the trend (churn), and how many new/up/down alerts would have been sent.
+Nothing is sent to Slack or S3 and no trend state is written.
+
+    python backtest.py --thresholds 10,15,20 --windows 4,6,8 --start 2024-01-01 --output backtest.csv
+"""
+import argparse
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from trends import MIN_INCREASE_PERCENTAGE, TREND_WINDOW, sort_for_trends
+
+
+NEW, UP, DOWN = 0, 1, 2
+STATUSES = ('new', 'up', 'down')
+
+DAILY_COLUMNS = ['threshold', 'window', 'date', 'videos', 'trending', 'entered', 'exited', 'churn',
+                 'alerts', 'new', 'up', 'down']
+
+
+def video_codes(df):
+    # Integer code per row for video_id; cheap for the categorical frames the loaders return
+    video_ids = df['video_id']
+    if isinstance(video_ids.dtype, pd.CategoricalDtype):
+        return video_ids.cat.codes.to_numpy(dtype=np.int64)
+    return pd.factorize(video_ids)[0].astype(np.int64)
+
+
+def increase_runs(values, first_row):
+    # Number of consecutive day-over-day increases ending at each row, within each video.
+    # first_row marks the first row of every video; NaN never counts as an increase.
+    n = len(values)
+    index = np.arange(n, dtype=np.int64)
+    increased = np.zeros(n, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        increased[1:] = values[1:] > values[:-1]
+    increased &= ~first_row
+    last_break = np.maximum.accumulate(np.where(increased, 0, index))
+    return index - last_break
+
+
+def rule_at_every_row(values, positions, runs, window, min_increase_percentage):
+    """
+    The is_trending rule evaluated as if each row were a video's most recent day.
+
+    Row i trends when its video has at least `window` rows up to i, the last
+    window - 1 day-over-day changes are all increases, and the increase from
+    row i - window + 1 to row i is at least min_increase_percentage.
+    """
+    lag = window - 1
+    start_values = np.full(len(values), np.nan)
+    start_values[lag:] = values[:len(values) - lag]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage_increase = (values - start_values) / start_values * 100
+        return (positions >= lag) & (runs >= lag) & (percentage_increase >= min_increase_percentage)
+
+
+def replay_alerts(codes, values, trending, exits=None):
+    """
+    Replay the alert decisions of iter_trend_alerts over the trending rows.
+
+    Per video: the first trending day is 'new'; later ones are 'up' or 'down'
+    against the moving average of the last alert, or nothing if unchanged. An alert
+    with the same status as the last one is skipped and leaves the state alone.
+    `exits` marks rows where a --sweep run would have stopped tracking the video.
+    Only those sparse rows are visited. Returns (alert_rows, alert_statuses).
+    """
+    events = trending if exits is None else trending | exits
+    rows = np.flatnonzero(events)
+    alert_rows, alert_statuses = [], []
+    last_video, last_value, last_status = -1, None, None
+    for row, video, value, is_trending in zip(rows.tolist(), codes[rows].tolist(), values[rows].tolist(),
+                                              trending[rows].tolist()):
+        if video != last_video:
+            last_video, last_value, last_status = video, None, None
+        if not is_trending:
+            last_value, last_status = None, None
+            continue
+        if last_value is None:
+            status = NEW
+        elif value > last_value:
+            status = UP
+        elif value < last_value:
+            status = DOWN
+        else:
+            continue
+        if status == last_status:
+            continue
+        alert_rows.append(row)
+        alert_statuses.append(status)
+        last_value, last_status = value, status
+    return np.array(alert_rows, dtype=np.int64), np.array(alert_statuses, dtype=np.int64)
+
+
+def backtest(df, thresholds=(MIN_INCREASE_PERCENTAGE,), windows=(TREND_WINDOW,), start=None, end=None,
+             sweep=False, presorted=False):
+    """
+    Backtest every (threshold, window) combination over the history in df.
+
+    df has the fetch_moving_averages columns; presorted=True skips sorting it by
+    video_id and date. Days before `start` still feed the windows and the alert state
+    but are not reported. sweep=True also replays the --sweep run after every day,
+    which stops tracking a video on its first day off the trend.
+    Returns (daily, summary) DataFrames, one row per setting and day, and per setting.
+    """
+    sorted_df = df if presorted else sort_for_trends(df)
+    codes = video_codes(sorted_df)
+    values = sorted_df['moving_average'].to_numpy(dtype=np.float64, na_value=np.nan)
+    days = sorted_df['date'].to_numpy(dtype='datetime64[D]').astype(np.int64)
+    n = len(values)
+
+    first_row = np.ones(n, dtype=bool)
+    first_row[1:] = codes[1:] != codes[:-1]
+    group_starts = np.flatnonzero(first_row)
+    positions = np.arange(n, dtype=np.int64) - np.repeat(group_starts, np.diff(np.append(group_starts, n)))
+    runs = increase_runs(values, first_row)
+
+    first_day = int(days.min()) if n else 0
+    day_index = days - first_day
+    n_days = int(day_index.max()) + 1 if n else 0
+    day_dates = np.datetime64('1970-01-01', 'D') + np.arange(first_day, first_day + n_days)
+    reported = np.ones(n_days, dtype=bool)
+    if start is not None:
+        reported &= day_dates >= np.datetime64(start, 'D')
+    if end is not None:
+        reported &= day_dates <= np.datetime64(end, 'D')
+    videos_per_day = np.bincount(day_index, minlength=n_days)
+    reported &= videos_per_day > 0
+
+    def per_day(mask):
+        return np.bincount(day_index[mask], minlength=n_days)
+
+    daily = []
+    for window in windows:
+        for threshold in thresholds:
+            trending = rule_at_every_row(values, positions, runs, window, threshold)
+            previous = np.zeros(n, dtype=bool)
+            previous[1:] = trending[:-1]
+            previous &= ~first_row
+            entered, exited = trending & ~previous, ~trending & previous
+
+            alert_rows, alert_statuses = replay_alerts(codes, values, trending, exited if sweep else None)
+            alerts = {name: np.bincount(day_index[alert_rows[alert_statuses == status]], minlength=n_days)
+                      for status, name in enumerate(STATUSES)}
+
+            counts = pd.DataFrame({
+                'threshold': threshold,
+                'window': window,
+                'date': day_dates,
+                'videos': videos_per_day,
+                'trending': per_day(trending),
+                'entered': per_day(entered),
+                'exited': per_day(exited),
+                **alerts,
+            })[reported]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                counts['churn'] = (counts['entered'] + counts['exited']) / counts['trending'].where(counts['trending'] > 0)
+            counts['alerts'] = counts['new'] + counts['up'] + counts['down']
+            daily.append(counts[DAILY_COLUMNS])
+
+    daily = pd.concat(daily, ignore_index=True) if daily else pd.DataFrame(columns=DAILY_COLUMNS)
+    summary = daily.groupby(['threshold', 'window']).agg(
+        days=('date', 'size'),
+        alerts=('alerts', 'sum'),
+        alerts_per_day=('alerts', 'mean'),
+        max_alerts_per_day=('alerts', 'max'),
+        new=('new', 'sum'),
+        up=('up', 'sum'),
+        down=('down', 'sum'),
+        trending_per_day=('trending', 'mean'),
+        churn=('churn', 'mean'),
+    ).reset_index()
+    return daily, summary
+
+
+def load_history(source='statistics', last_n=None):
+    # Returns (df, presorted); the compact loader already sorts by video_id and date
+    from db import get_cursor
+    if source == 'snapshot':
+        from snapshot import fetch_snapshot_frame
+        return fetch_snapshot_frame(), False
+    from compact import fetch_compact
+    with get_cursor() as cursor:
+        df, _ = fetch_compact(cursor, last_n)
+    return df, True
+
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest the trend rule over the stored history, without alerting.")
+    parser.add_argument('--thresholds', default=str(MIN_INCREASE_PERCENTAGE),
+                        help="Comma separated minimum increase percentages, e.g. 10,15,20")
+    parser.add_argument('--windows', default=str(TREND_WINDOW),
+                        help="Comma separated window lengths in days, e.g. 4,6,8")
+    parser.add_argument('--start', type=datetime.date.fromisoformat, default=None,
+                        help="First day to report (earlier days still feed the windows and alert state)")
+    parser.add_argument('--end', type=datetime.date.fromisoformat, default=None, help="Last day to report")
+    parser.add_argument('--last-n', type=int, default=None,
+                        help="Only load the N most recent days of each video (at least the reported days plus the window)")
+    parser.add_argument('--source', choices=['statistics', 'snapshot'], default='statistics',
+                        help="Load the history from the database or from the local columnar snapshot")
+    parser.add_argument('--sweep', action='store_true',
+                        help="Replay main.py --sweep after every day, so a video alerts as new again after a pause")
+    parser.add_argument('--output', help="Write the per-day results to this CSV file")
+    args = parser.parse_args()
+
+    df, presorted = load_history(args.source, args.last_n)
+    print(f"Backtesting {len(df)} rows of {df['video_id'].nunique()} videos...")
+    daily, summary = backtest(df, parse_list(args.thresholds, float), parse_list(args.windows, int),
+                              args.start, args.end, args.sweep, presorted)
+    print(summary.to_string(index=False))
+    if args.output:
+        daily.to_csv(args.output, index=False)
+        print(f"Wrote {len(daily)} daily rows to {args.output}.")
+
+
+if __name__ == '__main__':
+    main()
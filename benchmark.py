@@ -0,0 +1,326 @@
+"""
+Benchmark harness for the trend pipeline.
+
+Generates synthetic video_view_statistics rows and times each stage on its own:
+fetch into a DataFrame, groupby/sort, trend classification, chart rendering,
+Slack payload building and end-to-end alert delivery. The database, S3 and Slack
+are replaced by local stubs, so nothing leaves the machine.
+
+    python benchmark.py --videos 100000 --min-history 10 --max-history 60 --output bench.json
+    python benchmark.py --videos 5000000 --chunk-videos 50000 --legacy-sample 0 --output bench.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from decimal import Decimal
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from slack_api import SlackClient
+
+
+def generate_statistics(videos, min_history=6, max_history=60, trending_fraction=0.02,
+                        end_date=datetime.date(2024, 6, 30), seed=0, first_video=0):
+    """
+    Build synthetic video_view_statistics columns with numpy.
+
+    Each video gets a random history length, a log-normal base level and a noisy
+    daily drift. A trending_fraction of videos get a steady rise over their last
+    6 days so the classifier has something to find. Videos are numbered from
+    first_video, so chunks generated separately get distinct ids. Returns a dict
+    of arrays ordered like the production query (video_id, date DESC).
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(min_history, max_history + 1, size=videos)
+    total = int(lengths.sum())
+    video_index = np.repeat(np.arange(videos), lengths)
+    starts = np.cumsum(lengths) - lengths
+    # Position of each row within its video, 0 = most recent day
+    age = np.arange(total) - np.repeat(starts, lengths)
+
+    base = rng.lognormal(mean=7, sigma=1.5, size=videos)
+    drift = rng.normal(0, 0.03, size=total)
+    # Cumulative drift walking back in time from the most recent day
+    walk = np.exp(pd.Series(drift).groupby(video_index).cumsum().to_numpy())
+    moving_average = base[video_index] * walk
+
+    trending = rng.random(videos) < trending_fraction
+    boost = np.where(trending[video_index] & (age < 6), 1.0 + 0.08 * (6 - age), 1.0)
+    recent = trending[video_index] & (age < 6)
+    moving_average = np.where(recent, base[video_index] * boost, moving_average)
+
+    dates = np.datetime64(end_date) - age.astype('timedelta64[D]')
+    video_index += first_video
+    return {
+        'video_title': np.char.add('Synthetic video ', video_index.astype(str)),
+        'video_id': np.char.add('vid', np.char.zfill(video_index.astype(str), 8)),
+        'date': dates,
+        'moving_average': np.round(moving_average, 2),
+    }
+
+
+def to_db_rows(columns, decimal=False):
+    # Rows shaped like psycopg2's fetchall(): tuples of str, datetime.date and Decimal/float
+    values = columns['moving_average'].tolist()
+    if decimal:
+        values = [Decimal(str(value)) for value in values]
+    return list(zip(columns['video_title'].tolist(), columns['video_id'].tolist(),
+                    columns['date'].astype('datetime64[D]').tolist(), values))
+
+
+def to_compact_rows(columns):
+    # Rows shaped like compact_query's: one per video, with day numbers and floats in date order
+    video_ids = columns['video_id']
+    change = np.flatnonzero(video_ids[1:] != video_ids[:-1]) + 1
+    starts, stops = np.concatenate(([0], change)), np.concatenate((change, [len(video_ids)]))
+    days = columns['date'].astype('datetime64[D]').astype(np.int64)
+    values = columns['moving_average']
+    return [(video_ids[start], columns['video_title'][start], f"https://www.youtube.com/watch?v={video_ids[start]}",
+             days[start:stop][::-1].tolist(), values[start:stop][::-1].tolist())
+            for start, stop in zip(starts.tolist(), stops.tolist())]
+
+
+def chunks(videos, chunk_videos):
+    # (first_video, videos) of each chunk; chunk_videos=0 keeps everything in one chunk
+    chunk_videos = chunk_videos or videos
+    return [(first, min(chunk_videos, videos - first)) for first in range(0, videos, chunk_videos)]
+
+
+def add_timings(total, timing):
+    # Sum the timings of one chunk into the stage's running total
+    if total is None:
+        return dict(timing)
+    for key in ('min', 'median'):
+        total[key] += timing[key]
+    return total
+
+
+def time_stage(func, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return result, {'min': min(timings), 'median': statistics.median(timings), 'runs': len(timings)}
+
+
+class StubResponse:
+    status_code = 200
+    text = '{"ok": true}'
+    headers = {}
+
+    def json(self):
+        return {'ok': True}
+
+
+def plot_legacy(group, title):
+    # The pipeline's original pyplot chart, for the render_legacy comparison
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    plt.figure(figsize=(10, 6))
+    plt.plot(group['date'], group['moving_average'], marker='o', linestyle='-', color='b')
+    plt.title(title)
+    plt.xlabel('Date')
+    plt.ylabel('Moving Average of Views')
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    img_buf = BytesIO()
+    plt.savefig(img_buf, format='png')
+    plt.close()
+    img_buf.seek(0)
+    return img_buf
+
+
+def install_stubs(main):
+    # Replace every external service used by send_slack_alert with a local no-op
+    main.get_video_url = lambda video_id: f"https://www.youtube.com/watch?v={video_id}"
+    main.upload_chart_to_s3 = lambda bucket_name, s3_file_name, png: f"https://{bucket_name}.s3.amazonaws.com/{s3_file_name}"
+    # The real Slack client with a stub session and no rate limits, so retries and payloads still run
+    slack = SlackClient(token='benchmark', rate_limits={},
+                        session=SimpleNamespace(post=lambda *args, **kwargs: StubResponse()))
+    main.get_slack_client = lambda: slack
+    main.warm_for_alert = lambda video_url: None
+    # Keep alert events in memory (they are still counted) instead of printing them into the report
+    main.metrics.configure([])
+
+
+# Imported in a fresh interpreter; reports the wall time and which heavy dependencies got loaded
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = ['pandas', 'numpy', 'matplotlib', 'boto3', 'tqdm', 'main']
+print(json.dumps({{'seconds': elapsed, 'loaded': [name for name in heavy if name in sys.modules]}}))
+"""
+
+
+def time_import(module, repeat):
+    # Cold import time of a module, as a gunicorn worker pays it on boot
+    timings, loaded = [], []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module=module)],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        loaded = result['loaded']
+    return {'min': min(timings), 'median': statistics.median(timings), 'runs': len(timings), 'loaded': loaded}
+
+
+def run_benchmarks(args):
+    # Keep rendered charts out of the real cache so every run really renders
+    os.environ['CHART_CACHE_DIR'] = tempfile.mkdtemp(prefix='trend_bench_')
+    import main
+    import charts
+    from alert_queue import AlertDispatcher
+    from compact import rows_to_compact_frame
+    from trends import detect_trends, sort_for_trends
+
+    install_stubs(main)
+    report = {
+        'config': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+        },
+        'stages': {},
+    }
+    stages = report['stages']
+
+    for module in ('app', 'main'):
+        stages[f'import_{module}'] = time_import(module, args.repeat)
+    if args.import_only:
+        return report
+
+    # Data stages run one chunk of videos at a time, so the Python row objects that stand in
+    # for psycopg2's results only ever exist for one chunk; timings and sizes are summed
+    row_count, trending_count, legacy_sample, groups = 0, 0, None, []
+    memory = {'frame': 0, 'compact_frame': 0}
+    video_chunks = chunks(args.videos, args.chunk_videos)
+    for chunk, (first_video, videos) in enumerate(video_chunks):
+        timings = {}
+        columns, timings['generate'] = time_stage(
+            lambda: generate_statistics(videos, args.min_history, args.max_history, args.trending_fraction,
+                                        seed=args.seed + chunk, first_video=first_video), 1)
+        rows = to_db_rows(columns, decimal=args.decimal)
+        compact_rows = to_compact_rows(columns)
+        del columns
+        row_count += len(rows)
+
+        df, timings['fetch'] = time_stage(
+            lambda: pd.DataFrame(rows, columns=main.MOVING_AVERAGE_COLUMNS), args.repeat)
+        del rows
+        (compact_df, _), timings['fetch_compact'] = time_stage(lambda: rows_to_compact_frame(compact_rows), args.repeat)
+        del compact_rows
+        memory['frame'] += int(df.memory_usage(deep=True).sum())
+        memory['compact_frame'] += int(compact_df.memory_usage(deep=True).sum())
+
+        sorted_df, timings['sort'] = time_stage(lambda: sort_for_trends(df), args.repeat)
+        _, timings['groupby'] = time_stage(
+            lambda: sum(1 for _ in df.groupby('video_id')), args.repeat)
+        _, timings['classify_compact'] = time_stage(
+            lambda: detect_trends(compact_df, presorted=True), args.repeat)
+        del compact_df
+        (_, results), timings['classify'] = time_stage(
+            lambda: detect_trends(sorted_df, presorted=True), args.repeat)
+        trending_count += int(results['is_trending'].sum())
+        for name, timing in timings.items():
+            stages[name] = add_timings(stages.get(name), timing)
+
+        if chunk == 0:
+            # The legacy loop, charts and delivery work on a handful of videos, taken from the first chunk
+            if args.legacy_sample:
+                sample_ids = df['video_id'].drop_duplicates().head(args.legacy_sample)
+                legacy_sample = df[df['video_id'].isin(sample_ids)]
+            trending = results[results['is_trending']].head(args.charts)
+            groups = [sorted_df.iloc[start:stop].copy() for start, stop in zip(trending['start'], trending['stop'])]
+        del df, sorted_df, results
+
+    report['rows'] = row_count
+    report['chunks'] = len(video_chunks)
+    report['memory_bytes'] = memory
+    report['trending'] = trending_count
+
+    if legacy_sample is not None:
+        # The original per-group loop, on a sample of videos, for comparison
+        _, stages['classify_legacy_sample'] = time_stage(
+            lambda: [main.is_trending(group.sort_values(by='date'))
+                     for _, group in legacy_sample.groupby('video_id')], 1)
+        stages['classify_legacy_sample']['videos'] = int(legacy_sample['video_id'].nunique())
+
+    if groups:
+        _, stages['render'] = time_stage(
+            lambda: [charts._draw(group['video_title'].iloc[0], *charts._series(group)) for group in groups],
+            args.repeat)
+        _, stages['render_legacy'] = time_stage(
+            lambda: [plot_legacy(group, group['video_title'].iloc[0]) for group in groups],
+            args.repeat)
+        _, stages['payload'] = time_stage(
+            lambda: [main.build_slack_message(group['video_title'].iloc[0], 'https://youtube.com/watch?v=x',
+                                              'https://example.com/chart.png', 'new') for group in groups],
+            args.repeat)
+
+        def deliver():
+            with AlertDispatcher(main.send_slack_alert, max_workers=args.workers) as dispatcher:
+                for group in groups:
+                    dispatcher.submit(group['video_id'].iloc[0], group, 'new')
+            return dispatcher
+
+        _, stages['deliver'] = time_stage(deliver, 1)
+        for name in ('render', 'render_legacy', 'payload', 'deliver'):
+            stages[name]['charts'] = len(groups)
+
+    for name, stage in stages.items():
+        if name in ('fetch', 'fetch_compact', 'sort', 'groupby', 'classify', 'classify_compact') and stage['min'] > 0:
+            stage['rows_per_second'] = row_count / stage['min']
+    # Per-alert render/upload/post histograms recorded by the pipeline itself during the deliver stage
+    report['metrics'] = main.metrics.snapshot()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the trend detection pipeline on synthetic data.")
+    parser.add_argument('--videos', type=int, default=10000)
+    parser.add_argument('--min-history', type=int, default=6)
+    parser.add_argument('--max-history', type=int, default=60)
+    parser.add_argument('--chunk-videos', type=int, default=50000,
+                        help="Videos generated and timed per chunk, which bounds memory (0 for a single chunk)")
+    parser.add_argument('--trending-fraction', type=float, default=0.02)
+    parser.add_argument('--decimal', action='store_true',
+                        help="Return moving averages as Decimal, like a NUMERIC column through psycopg2")
+    parser.add_argument('--charts', type=int, default=20, help="Trending videos to render and deliver")
+    parser.add_argument('--workers', type=int, default=8, help="Alert worker threads for the deliver stage")
+    parser.add_argument('--legacy-sample', type=int, default=2000,
+                        help="Videos to run through the per-group is_trending loop (0 to skip)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--import-only', action='store_true', help="Only time the cold imports of app and main")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args)
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
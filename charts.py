@@ -0,0 +1,147 @@
+import hashlib
+import os
+import tempfile
+import threading
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import AutoDateFormatter, AutoDateLocator, date2num
+from matplotlib.figure import Figure
+
+
+# Rendered PNGs are kept on local disk under the hash of what they show
+CHART_CACHE_DIR = os.environ.get('CHART_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'trend_charts'))
+CHART_CACHE_MAX_BYTES = int(os.environ.get('CHART_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Bump when the chart layout changes so old cache entries are not reused
+CHART_STYLE_VERSION = b'1'
+
+_local = threading.local()
+_cache_lock = threading.Lock()
+# Running total of the cache size, so the directory is only scanned when it may be over the limit
+_cache_bytes = None
+
+
+def _build_chart():
+    # One figure per thread, built once and reused by swapping the line data.
+    # Figure/FigureCanvasAgg avoid pyplot's global state, so threads don't share anything.
+    figure = Figure(figsize=(10, 6))
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    line, = ax.plot([], [], marker='o', linestyle='-', color='b')
+    locator = AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(AutoDateFormatter(locator))
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Moving Average of Views')
+    ax.tick_params(axis='x', labelrotation=45)
+    # Fixed margins instead of tight_layout on every render
+    figure.subplots_adjust(left=0.1, right=0.97, bottom=0.2, top=0.93)
+    return figure, ax, line
+
+
+def _get_chart():
+    chart = getattr(_local, 'chart', None)
+    if chart is None:
+        chart = _local.chart = _build_chart()
+    return chart
+
+
+def _series(group):
+    dates = date2num(pd.to_datetime(group['date']).to_numpy())
+    values = group['moving_average'].to_numpy(dtype=np.float64)
+    return np.ascontiguousarray(dates, dtype=np.float64), np.ascontiguousarray(values)
+
+
+def chart_digest(title, dates, values):
+    # Content hash of everything that ends up on the chart
+    digest = hashlib.sha256(CHART_STYLE_VERSION)
+    digest.update(str(title).encode('utf-8'))
+    digest.update(dates.tobytes())
+    digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def _draw(title, dates, values):
+    figure, ax, line = _get_chart()
+    line.set_data(dates, values)
+    ax.set_title(title)
+    ax.relim()
+    ax.autoscale_view()
+    img_buf = BytesIO()
+    figure.savefig(img_buf, format='png')
+    return img_buf.getvalue()
+
+
+def _cache_path(digest):
+    return os.path.join(CHART_CACHE_DIR, f"{digest}.png")
+
+
+def _read_cached(digest):
+    path = _cache_path(digest)
+    try:
+        with open(path, 'rb') as f:
+            png = f.read()
+        os.utime(path)  # Mark as recently used for LRU eviction
+        return png
+    except OSError:
+        return None
+
+
+def _write_cached(digest, png):
+    global _cache_bytes
+    try:
+        os.makedirs(CHART_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{_cache_path(digest)}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(png)
+        os.replace(tmp_path, _cache_path(digest))
+        with _cache_lock:
+            if _cache_bytes is not None:
+                _cache_bytes += len(png)
+        if _cache_bytes is None or _cache_bytes > CHART_CACHE_MAX_BYTES:
+            evict_chart_cache()
+    except OSError as e:
+        print(f"An error occurred while caching chart {digest}: {e}")
+
+
+def evict_chart_cache(max_bytes=None):
+    # Delete the least recently used charts until the cache fits in max_bytes
+    global _cache_bytes
+    max_bytes = CHART_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with _cache_lock:
+        entries = []
+        with os.scandir(CHART_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('.png'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        _cache_bytes = total
+
+
+def render_chart(group, title):
+    """
+    Render the moving average chart of one video as PNG bytes.
+
+    Returns (digest, png). The digest is a hash of the plotted series and title,
+    so unchanged data is served from the local cache instead of being redrawn.
+    Safe to call from several threads at once.
+    """
+    dates, values = _series(group)
+    digest = chart_digest(title, dates, values)
+    png = _read_cached(digest)
+    if png is None:
+        png = _draw(title, dates, values)
+        _write_cached(digest, png)
+    return digest, png
@@ -0,0 +1,73 @@
+import os
+import threading
+import time
+
+from db import get_cursor
+
+
+# Seconds a video's top comments are served from memory before they are read again
+COMMENTS_CACHE_TTL = float(os.environ.get('COMMENTS_CACHE_TTL', 900))
+COMMENTS_CACHE_SIZE = int(os.environ.get('COMMENTS_CACHE_SIZE', 2000))
+
+# video_url -> (expires_at, comments)
+_cache = {}
+_cache_lock = threading.Lock()
+
+# The cache is per process, so warming it on alerts only pays off in a process that also
+# serves "View Details" (the Flask app); the main.py CLI would only spend a query per alert
+_warm_on_alert = False
+
+
+def fetch_top_comments(video_url, limit=5):
+    # Execute SQL query to fetch the top comments for the given video URL.
+    # Benefits from an index on comments (video_url, likes DESC).
+    with get_cursor() as cursor:
+        query = """
+        SELECT *
+        FROM comments
+        WHERE video_url = %s
+        ORDER BY likes DESC
+        LIMIT %s;
+        """
+        cursor.execute(query, (video_url, limit))
+        return cursor.fetchall()
+
+
+def cached_top_comments(video_url):
+    # Comments from the cache, or None when they are missing or expired
+    with _cache_lock:
+        entry = _cache.get(video_url)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def warm_top_comments(video_url):
+    # Read the comments from the database and (re)fill the cache entry
+    comments = fetch_top_comments(video_url)
+    with _cache_lock:
+        _cache.pop(video_url, None)
+        _cache[video_url] = (time.monotonic() + COMMENTS_CACHE_TTL, comments)
+        # Dicts keep insertion order, so the first keys are the oldest entries
+        while len(_cache) > COMMENTS_CACHE_SIZE:
+            del _cache[next(iter(_cache))]
+    return comments
+
+
+def enable_alert_warming():
+    # Called by the Flask app, whose background jobs send alerts the same worker may open details for
+    global _warm_on_alert
+    _warm_on_alert = True
+
+
+def warm_for_alert(video_url):
+    # Pre-warm the cache for an alert's video when this process serves the details modal
+    if _warm_on_alert and video_url:
+        warm_top_comments(video_url)
+
+
+def get_top_comments(video_url):
+    comments = cached_top_comments(video_url)
+    if comments is None:
+        comments = warm_top_comments(video_url)
+    return comments
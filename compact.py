@@ -0,0 +1,87 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from sharding import SHARD_SQL
+
+
+def compact_query(last_n=None, shard=None):
+    """
+    One row per video: its id, title and video_url, and its dates and moving
+    averages as arrays in date order.
+
+    Titles and URLs cross the wire once per video instead of once per row. Dates
+    come back as day numbers and moving averages as double precision (NULL as NaN),
+    so psycopg2 never builds a date or Decimal object per row. The URL is read from
+    videos in the same query, so alerts need no per-video URL lookup.
+    """
+    where, params = '', ()
+    if shard is not None:
+        where = f'WHERE {SHARD_SQL} = %s'
+        params = (shard[1], shard[0])
+    query = f'''
+    SELECT s.video_id,
+           (array_agg(s.video_title ORDER BY s.date))[1],
+           -- videos may hold several rows for a video_id; take a single URL so there is one row per video
+           (SELECT v.video_url FROM videos v WHERE v.video_id = s.video_id LIMIT 1),
+           array_agg(s.date::date - DATE '1970-01-01' ORDER BY s.date),
+           array_agg(coalesce(s.moving_average::double precision, 'NaN') ORDER BY s.date)
+    FROM video_view_statistics s
+    {where}
+    GROUP BY s.video_id
+    ORDER BY s.video_id
+    '''
+    if last_n is None:
+        return query, params
+    query = f'''
+    SELECT video_id, video_title, video_url,
+           days[greatest(cardinality(days) - %s + 1, 1):],
+           moving_averages[greatest(cardinality(moving_averages) - %s + 1, 1):]
+    FROM ({query}) AS videos_compact (video_id, video_title, video_url, days, moving_averages)
+    ORDER BY video_id
+    '''
+    return query, (last_n, last_n) + params
+
+
+def rows_to_compact_frame(rows, dtype=np.float64):
+    """
+    Turn compact_query rows into (df, videos).
+
+    df has one row per video and day, sorted by video_id then date, like sort_for_trends:
+    categorical video_id and video_title (integer codes per row), datetime64 dates and
+    a float64 (or dtype, e.g. float32) moving_average. videos is the per-video side
+    table indexed by video_id, with video_title and video_url.
+    """
+    if not rows:
+        empty = pd.DataFrame({
+            'video_title': pd.Categorical([]),
+            'video_id': pd.Categorical([]),
+            'date': np.array([], dtype='datetime64[D]'),
+            'moving_average': np.array([], dtype=dtype),
+        })
+        return empty, pd.DataFrame(columns=['video_title', 'video_url'], index=pd.Index([], name='video_id'))
+
+    video_ids, titles, video_urls, days, moving_averages = zip(*rows)
+    lengths = np.fromiter((len(window) for window in days), dtype=np.int64, count=len(days))
+    total = int(lengths.sum())
+    video_codes = np.repeat(np.arange(len(video_ids), dtype=np.int32), lengths)
+    # Different videos may share a title, so titles get their own dictionary
+    title_codes, title_categories = pd.factorize(pd.Series(titles, dtype=object))
+    df = pd.DataFrame({
+        'video_title': pd.Categorical.from_codes(np.repeat(title_codes, lengths), categories=title_categories),
+        'video_id': pd.Categorical.from_codes(video_codes, categories=pd.Index(video_ids, dtype=object)),
+        'date': np.fromiter(itertools.chain.from_iterable(days), dtype=np.int64, count=total).astype('datetime64[D]'),
+        'moving_average': np.fromiter(itertools.chain.from_iterable(moving_averages), dtype=np.float64,
+                                      count=total).astype(dtype, copy=False),
+    })
+    videos = pd.DataFrame({'video_title': titles, 'video_url': video_urls},
+                          index=pd.Index(video_ids, name='video_id'))
+    return df, videos
+
+
+def fetch_compact(cursor, last_n=None, shard=None, dtype=np.float64):
+    # Fetch video_view_statistics (optionally the last_n days per video, or one shard) compactly
+    query, params = compact_query(last_n, shard)
+    cursor.execute(query, params)
+    return rows_to_compact_frame(cursor.fetchall(), dtype)
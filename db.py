@@ -0,0 +1,131 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# Database connection parameters using environment variables
+db_params = {
+    'database': os.environ.get('DB_NAME'),
+    'user': os.environ.get('DB_USER'),
+    'password': os.environ.get('DB_PASS'),
+    'host': os.environ.get('DB_HOST'),
+    'port': os.environ.get('DB_PORT')
+}
+
+# Pool sizing, per process. Each gunicorn worker gets its own pool.
+DB_POOL_MIN_CONN = int(os.environ.get('DB_POOL_MIN_CONN', 1))
+DB_POOL_MAX_CONN = int(os.environ.get('DB_POOL_MAX_CONN', 5))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# Run a cheap query on checkout to weed out connections the server has dropped
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') != '0'
+
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool, _pool_pid, _pool_slots
+    with _pool_lock:
+        # A pool inherited through fork shares sockets with the parent, so start a new one
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = pool.ThreadedConnectionPool(DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, **db_params)
+            _pool_pid = os.getpid()
+            # ThreadedConnectionPool raises when exhausted; the semaphore makes callers wait instead
+            _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONN)
+        return _pool
+
+
+def close_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _pool_pid = None
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if not DB_POOL_PRE_PING:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def get_connection():
+    # Check a connection out of the pool and always return it, rolling back
+    # anything the caller did not commit.
+    db_pool = get_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise pool.PoolError(f"No database connection available after {DB_POOL_TIMEOUT} seconds")
+    try:
+        conn = db_pool.getconn()
+        if not _is_healthy(conn):
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+        try:
+            yield conn
+        finally:
+            if not conn.closed and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    conn.close()
+            db_pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        slots.release()
+
+
+@contextmanager
+def get_cursor(commit=False):
+    # Shortcut for the common checkout-a-connection-and-run-a-query case
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            yield cursor
+        if commit:
+            conn.commit()
+
+
+
+@contextmanager
+def advisory_lock(*locks):
+    """
+    Hold Postgres session-level advisory locks for the duration of the block, on a
+    connection of its own so they do not take a slot from the pool.
+
+    Each lock is (key, shared), key being a bigint or a pair of ints. Yields True when
+    every lock was acquired and False when another session holds a conflicting one.
+    Closing the connection releases them, also if this process dies mid-run.
+    """
+    conn = psycopg2.connect(**db_params)
+    try:
+        conn.autocommit = True
+        acquired = True
+        with conn.cursor() as cursor:
+            for key, shared in locks:
+                keys = key if isinstance(key, tuple) else (key,)
+                function = 'pg_try_advisory_lock_shared' if shared else 'pg_try_advisory_lock'
+                cursor.execute(f"SELECT {function}({', '.join(['%s'] * len(keys))})", keys)
+                if not cursor.fetchone()[0]:
+                    acquired = False
+                    break
+        yield acquired
+    finally:
+        conn.close()
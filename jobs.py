@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Seconds between writes of a running job's progress to the job store
+JOB_PROGRESS_INTERVAL = float(os.environ.get('JOB_PROGRESS_INTERVAL', 5))
+
+
+class PostgresJobStore:
+    """
+    Job snapshots in the pipeline_jobs table, so every gunicorn worker can report
+    on a job whichever worker started it.
+    """
+
+    def __init__(self):
+        self._table_ready = False
+
+    def _cursor(self):
+        # db pulls in psycopg2 only, but keep it off the import path of app boot all the same
+        from db import get_cursor
+        return get_cursor(commit=True)
+
+    def _ensure_table(self, cursor):
+        if not self._table_ready:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pipeline_jobs (
+                id TEXT PRIMARY KEY,
+                job JSONB NOT NULL,
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
+            );
+            ''')
+            self._table_ready = True
+
+    def save(self, job):
+        with self._cursor() as cursor:
+            self._ensure_table(cursor)
+            cursor.execute('''
+            INSERT INTO pipeline_jobs (id, job, updated_at) VALUES (%s, %s, now())
+            ON CONFLICT (id) DO UPDATE SET job = EXCLUDED.job, updated_at = EXCLUDED.updated_at;
+            ''', (job['id'], json.dumps(job, default=str)))
+
+    def load(self, job_id):
+        with self._cursor() as cursor:
+            self._ensure_table(cursor)
+            cursor.execute('SELECT job FROM pipeline_jobs WHERE id = %s', (job_id,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+    def running_job_id(self, exclude=None, max_age=None):
+        # The newest job other than `exclude` still reporting progress, i.e. the run holding the pipeline lock
+        max_age = JOB_PROGRESS_INTERVAL * 3 if max_age is None else max_age
+        with self._cursor() as cursor:
+            self._ensure_table(cursor)
+            cursor.execute('''
+            SELECT id FROM pipeline_jobs
+            WHERE job->>'status' = 'running' AND updated_at > now() - make_interval(secs => %s)
+              AND id IS DISTINCT FROM %s
+            ORDER BY updated_at DESC LIMIT 1
+            ''', (max_age, exclude))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+
+class JobRunner:
+    """
+    Runs pipeline jobs one at a time on a background thread.
+
+    A trigger that arrives while a job is queued or running is merged into that
+    job instead of starting another run. Across processes the run itself merges
+    triggers (main.run_pipeline takes a Postgres advisory lock); a job whose run
+    found another one going finishes as 'merged', pointing at the running job.
+    With a store (PostgresJobStore), job snapshots are saved as they change, so
+    get() finds jobs started by other gunicorn workers.
+    """
+
+    def __init__(self, history=50, store=None, progress_interval=JOB_PROGRESS_INTERVAL):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline')
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._active_id = None
+        self._history = history
+        self._store = store
+        self._progress_interval = progress_interval
+
+    def trigger(self, mode, run, progress):
+        """
+        Queue run(progress) unless a job is already queued or running.
+
+        progress is the dict the run updates as it goes. Returns (job, merged);
+        merged is True when the trigger was folded into the active job.
+        """
+        with self._lock:
+            if self._active_id is not None:
+                active = self._jobs[self._active_id]
+                active['merged_triggers'] += 1
+                return self._snapshot(active), True
+            job = {
+                'id': uuid.uuid4().hex,
+                'mode': mode,
+                'status': 'queued',
+                'progress': progress,
+                'merged_triggers': 0,
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'duration_seconds': None,
+                'error': None,
+            }
+            self._jobs[job['id']] = job
+            self._active_id = job['id']
+            while len(self._jobs) > self._history:
+                self._jobs.popitem(last=False)
+            self._save(job)
+            self._executor.submit(self._run, job, run)
+            return self._snapshot(job), False
+
+    def _run(self, job, run):
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        self._save(job)
+        done = threading.Event()
+        reporter = threading.Thread(target=self._report_progress, args=(job, done), daemon=True)
+        reporter.start()
+        try:
+            run(job['progress'])
+            if job['progress'].get('merged'):
+                job['status'] = 'merged'
+                job['merged_into'] = self._running_job_id(job['id'])
+            else:
+                job['status'] = 'finished'
+        except Exception as e:
+            traceback.print_exc()
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        finally:
+            done.set()
+            reporter.join()
+            job['finished_at'] = time.time()
+            job['duration_seconds'] = job['finished_at'] - job['started_at']
+            self._save(job)
+            with self._lock:
+                self._active_id = None
+
+    def _report_progress(self, job, done):
+        # Save the running job's progress now and then, for workers reading it from the store
+        while not done.wait(self._progress_interval):
+            self._save(job)
+
+    def _save(self, job):
+        if self._store is None:
+            return
+        try:
+            self._store.save(self._snapshot(job))
+        except Exception as e:
+            print(f"An error occurred while saving job {job['id']}: {e}")
+
+    def _running_job_id(self, exclude):
+        if self._store is None:
+            return None
+        try:
+            return self._store.running_job_id(exclude)
+        except Exception as e:
+            print(f"An error occurred while looking up the running job: {e}")
+            return None
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return self._snapshot(job)
+        if self._store is None:
+            return None
+        try:
+            return self._store.load(job_id)
+        except Exception as e:
+            print(f"An error occurred while loading job {job_id}: {e}")
+            return None
+
+    @staticmethod
+    def _snapshot(job):
+        snapshot = dict(job)
+        snapshot['progress'] = dict(job['progress'])
+        return snapshot
@@ -1,19 +1,27 @@
-import psycopg2
 import pandas as pd
-import matplotlib
-matplotlib.use('Agg')
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import matplotlib.font_manager as fm
+import argparse
 import base64
+import multiprocessing
 import os
 from dotenv import load_dotenv
-import requests
-from io import BytesIO
-import boto3
-from botocore.exceptions import NoCredentialsError
-import matplotlib.pyplot as plt
 import datetime
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from alert_queue import AlertDispatcher
+from comments import warm_for_alert
+from compact import fetch_compact
+from db import advisory_lock, get_connection, get_cursor
+from metrics import metrics
+from pushdown import check_parity, fetch_pushdown_candidates
+from recent_window import fetch_recent_windows, refresh_recent_windows
+from s3_uploader import get_uploader
+from sharding import SHARD_SQL, parse_shard_spec
+from slack_api import get_slack_client
+from snapshot import fetch_snapshot_frame
+from trend_state import TrendStateWriter
+from trends import TREND_WINDOW, detect_trends, detectors_window, parse_detectors, stateful_detectors
 
 
 
@@ -21,19 +29,16 @@ import datetime
 
 load_dotenv()
 
-# Database connection parameters using environment variables
-db_params = {
-    'database': os.environ.get('DB_NAME'),
-    'user': os.environ.get('DB_USER'),
-    'password': os.environ.get('DB_PASS'),
-    'host': os.environ.get('DB_HOST'),
-    'port': os.environ.get('DB_PORT')
-}
+# Alert delivery: worker threads, alerts allowed to wait for a worker, and seconds to wait for all of them
+ALERT_WORKERS = int(os.environ.get('ALERT_WORKERS', 8))
+ALERT_QUEUE_SIZE = int(os.environ.get('ALERT_QUEUE_SIZE', 32))
+ALERT_TIMEOUT = float(os.environ.get('ALERT_TIMEOUT', 600))
 
-# Slack webhook URL using an environment variable
-slack_webhook_url = os.environ.get('SLACK_WEBHOOK_URL')
+# Extra registered trend rules (see trends.DETECTORS) evaluated in the same pass, counted per rule
+TREND_DETECTORS = parse_detectors(os.environ.get('TREND_DETECTORS', ''))
+# Rows per video a run must fetch so every rule above sees its whole window
+FETCH_WINDOW = detectors_window(TREND_DETECTORS)
 
-SLACK_BOT_TOKEN = os.getenv('SLACK_BOT_TOKEN')
 
 def alert_already_sent(cursor, video_id, trend_status):
     # Check if an alert with the same trend status has already been sent for this video_id
@@ -44,70 +49,263 @@ def alert_already_sent(cursor, video_id, trend_status):
     cursor.execute(query, (video_id, trend_status))
     return cursor.fetchone() is not None
 
+def fetch_trend_state(cursor, video_ids=None):
+    # Load current_trending_videos in one query into a dict keyed by video_id.
+    # Pass video_ids to only load the rows for those videos.
+    query = 'SELECT video_id, last_moving_average, trend_status FROM current_trending_videos'
+    if video_ids is None:
+        cursor.execute(query)
+    else:
+        cursor.execute(query + ' WHERE video_id = ANY(%s)', (list(video_ids),))
+    return {video_id: {'last_moving_average': last_moving_average, 'trend_status': trend_status}
+            for video_id, last_moving_average, trend_status in cursor.fetchall()}
+
 def get_video_url(video_id):
     # Connect to the database and fetch the video URL
     try:
-        conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
-        query = 'SELECT video_url FROM videos WHERE video_id = %s'
-        cursor.execute(query, (video_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
+        with get_cursor() as cursor:
+            query = 'SELECT video_url FROM videos WHERE video_id = %s'
+            cursor.execute(query, (video_id,))
+            result = cursor.fetchone()
+            return result[0] if result else None
     except Exception as e:
         print(f"An error occurred while fetching the video URL: {e}")
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
 
 
-def update_trending_videos(trending_videos):
-    try:
-        conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
-        # Insert new trending videos
-        insert_query = 'INSERT INTO current_trending_videos (video_id) VALUES (%s) ON CONFLICT DO NOTHING'
-        # Remove videos that are no longer trending
-        remove_query = 'DELETE FROM current_trending_videos WHERE video_id NOT IN %s'
-        trending_video_ids = tuple(
-            [video_id for video_id, _ in trending_videos])
-
-        cursor.executemany(insert_query, [(video_id,)
-                           for video_id in trending_video_ids])
-        cursor.execute(remove_query, (trending_video_ids,))
-
-        conn.commit()
-    except Exception as e:
-        print(f"An error occurred while updating current trending videos: {e}")
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
+MOVING_AVERAGE_COLUMNS = ['video_title', 'video_id', 'date', 'moving_average']
 
+# Rows pulled per round trip by the server-side cursor when streaming
+STREAM_ITERSIZE = int(os.environ.get('STREAM_ITERSIZE', 10000))
 
-def fetch_moving_averages():
-    print("Fetching moving averages from the database...")
-    try:
-        conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
-        query = '''
+
+def moving_averages_query(last_n=None, shard=None):
+    # Rows come back grouped by video_id, newest first.
+    # With last_n only the last_n most recent rows (days) of each video are returned.
+    # With shard=(shard_id, shards) only the videos in that shard are returned.
+    where, params = '', ()
+    if shard is not None:
+        where = f'WHERE {SHARD_SQL} = %s'
+        params = (shard[1], shard[0])
+    if last_n is None:
+        query = f'''
         SELECT video_title, video_id, date, moving_average
         FROM video_view_statistics
+        {where}
         ORDER BY video_id, date DESC
         '''
-        cursor.execute(query)
-        results = cursor.fetchall()
-        df = pd.DataFrame(results, columns=[
-                          'video_title', 'video_id', 'date', 'moving_average'])
+        return query, params
+    query = f'''
+    SELECT video_title, video_id, date, moving_average
+    FROM (
+        SELECT video_title, video_id, date, moving_average,
+               ROW_NUMBER() OVER (PARTITION BY video_id ORDER BY date DESC) AS row_number
+        FROM video_view_statistics
+        {where}
+    ) recent
+    WHERE row_number <= %s
+    ORDER BY video_id, date DESC
+    '''
+    return query, params + (last_n,)
+
+
+def fetch_moving_averages(last_n=None, shard=None):
+    print("Fetching moving averages from the database...")
+    try:
+        with metrics.timer('fetch'):
+            with get_cursor() as cursor:
+                query, params = moving_averages_query(last_n, shard)
+                cursor.execute(query, params)
+                results = cursor.fetchall()
+            df = pd.DataFrame(results, columns=MOVING_AVERAGE_COLUMNS)
         return df
     except Exception as e:
         print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
     print("Finished fetching moving averages.")
 
+
+def fetch_compact_moving_averages(last_n=None, shard=None):
+    # Same rows as fetch_moving_averages in the compact layout (see compact.py), sorted by
+    # video_id and date, plus the per-video side table of titles and video_urls.
+    # Returns (df, videos), or (None, None) when the fetch fails.
+    print("Fetching moving averages from the database...")
+    try:
+        with metrics.timer('fetch'):
+            with get_cursor() as cursor:
+                return fetch_compact(cursor, last_n, shard)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    return None, None
+
+
+def fetch_recent_window_frame(last_n=None, rebuild=False):
+    # Refresh the per-video recent window table from the new statistics, then read it
+    # instead of sorting the full history of every video
+    print("Fetching moving averages from the recent window table...")
+    try:
+        with metrics.timer('fetch'), get_connection() as conn:
+            with conn.cursor() as cursor:
+                refreshed = refresh_recent_windows(cursor, rebuild=rebuild)
+                conn.commit()
+                print(f"Refreshed the recent window of {refreshed} videos.")
+                return fetch_recent_windows(cursor, last_n)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+def fetch_pushdown_frame(last_n=None):
+    # Evaluate the trend rule inside Postgres and only fetch the rows of the videos that pass it
+    print("Fetching trending candidates computed in the database...")
+    try:
+        with metrics.timer('fetch'):
+            with get_cursor() as cursor:
+                return fetch_pushdown_candidates(cursor, last_n=last_n)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+# Name of the watermark row that records how far incremental runs have processed the statistics
+STATISTICS_WATERMARK = 'video_view_statistics'
+# Days before the watermark that incremental runs scan again, to pick up statistics loaded late
+INCREMENTAL_LOOKBACK_DAYS = int(os.environ.get('INCREMENTAL_LOOKBACK_DAYS', 2))
+
+
+def as_date(value):
+    # Watermarks are compared as dates; a TIMESTAMP column or a timestamp-typed date reads back as datetime
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def ensure_watermark_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS trend_run_watermarks (
+        name TEXT PRIMARY KEY,
+        watermark TIMESTAMP NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+    );
+    ''')
+
+
+def get_watermark(cursor, name=STATISTICS_WATERMARK):
+    cursor.execute('SELECT watermark FROM trend_run_watermarks WHERE name = %s', (name,))
+    result = cursor.fetchone()
+    return as_date(result[0]) if result else None
+
+
+def set_watermark(cursor, watermark, name=STATISTICS_WATERMARK):
+    query = '''
+    INSERT INTO trend_run_watermarks (name, watermark, updated_at)
+    VALUES (%s, %s, now())
+    ON CONFLICT (name) DO UPDATE
+    SET watermark = EXCLUDED.watermark,
+        updated_at = EXCLUDED.updated_at;
+    '''
+    cursor.execute(query, (name, watermark))
+
+
+def fetch_incremental_moving_averages(since, window=TREND_WINDOW, lookback_days=INCREMENTAL_LOOKBACK_DAYS):
+    # Fetch the trailing `window` rows of every video that has statistics dated after
+    # `since` less lookback_days; the look-back picks up rows loaded after the previous run
+    # for dates it had already seen. Everything is bounded by the current max(date), which
+    # is returned as the next watermark, so rows arriving during the run are picked up by
+    # the next one. Returns (df, upto); upto is None when the table is empty.
+    rescan_from = since - datetime.timedelta(days=lookback_days) if since is not None else None
+    print(f"Fetching moving averages for videos with statistics after {rescan_from}...")
+    with get_cursor() as cursor:
+        cursor.execute('SELECT max(date) FROM video_view_statistics')
+        upto = as_date(cursor.fetchone()[0])
+        if upto is None:
+            return pd.DataFrame(columns=MOVING_AVERAGE_COLUMNS), upto
+        # On the first incremental run every video counts as changed
+        changed_filter = 'date <= %(upto)s' if since is None else 'date > %(since)s AND date <= %(upto)s'
+        query = f'''
+        WITH changed AS (
+            SELECT DISTINCT video_id
+            FROM video_view_statistics
+            WHERE {changed_filter}
+        )
+        SELECT video_title, video_id, date, moving_average
+        FROM (
+            SELECT s.video_title, s.video_id, s.date, s.moving_average,
+                   ROW_NUMBER() OVER (PARTITION BY s.video_id ORDER BY s.date DESC) AS row_number
+            FROM video_view_statistics s
+            JOIN changed USING (video_id)
+            WHERE s.date <= %(upto)s
+        ) recent
+        WHERE row_number <= %(window)s
+        ORDER BY video_id, date DESC
+        '''
+        cursor.execute(query, {'since': rescan_from, 'upto': upto, 'window': window})
+        results = cursor.fetchall()
+    return pd.DataFrame(results, columns=MOVING_AVERAGE_COLUMNS), upto
+
+
+def run_incremental(window=TREND_WINDOW, progress=None):
+    # Analyze only the videos with new statistics since the last incremental run, then
+    # advance the watermark once every alert of the run was delivered. With failed or
+    # timed-out alerts it stays put, so the next run scans those videos again.
+    progress = new_progress() if progress is None else progress
+    with get_cursor(commit=True) as cursor:
+        ensure_watermark_table(cursor)
+        since = get_watermark(cursor)
+
+    with metrics.timer('fetch'):
+        df, upto = fetch_incremental_moving_averages(since, window)
+    if upto is None:
+        print("No moving averages found to analyze.")
+        return []
+    trending_videos = []
+    if df.empty:
+        print(f"No new statistics since {since}.")
+    else:
+        trending_videos = analyze_videos(df, progress)
+
+    unsent = progress['alerts_queued'] - progress['alerts_sent']
+    if unsent:
+        print(f"Keeping the watermark at {since}: {unsent} alerts were not delivered.")
+        return trending_videos
+    with get_cursor(commit=True) as cursor:
+        set_watermark(cursor, max(upto, since) if since is not None else upto)
+    return trending_videos
+
+
+def iter_video_rows(last_n=None, itersize=STREAM_ITERSIZE):
+    # Stream video_view_statistics through a named server-side cursor and yield
+    # (video_id, rows) once per video, rows sorted by date ascending.
+    # The ORDER BY keeps each video's rows together, so only one video is held at a time.
+    query, params = moving_averages_query(last_n)
+    with get_connection() as conn:
+        with conn.cursor(name='video_view_statistics_stream') as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+            current_video_id, rows = None, []
+            for row in cursor:
+                if row[1] != current_video_id and rows:
+                    yield current_video_id, rows[::-1]
+                    rows = []
+                current_video_id = row[1]
+                rows.append(row)
+            if rows:
+                yield current_video_id, rows[::-1]
+
+
+def iter_video_groups(last_n=None, itersize=STREAM_ITERSIZE):
+    # Yield (video_id, group) with one complete, date-sorted DataFrame per video
+    for video_id, rows in iter_video_rows(last_n, itersize):
+        yield video_id, pd.DataFrame(rows, columns=MOVING_AVERAGE_COLUMNS)
+
+
+def iter_video_batches(batch_size=5000, last_n=None, itersize=STREAM_ITERSIZE):
+    # Yield DataFrames holding the complete rows of up to batch_size videos each,
+    # so the vectorized analysis still works on a bounded amount of memory
+    batch_rows, batch_videos = [], 0
+    for _, rows in iter_video_rows(last_n, itersize):
+        batch_rows.extend(rows)
+        batch_videos += 1
+        if batch_videos >= batch_size:
+            yield pd.DataFrame(batch_rows, columns=MOVING_AVERAGE_COLUMNS)
+            batch_rows, batch_videos = [], 0
+    if batch_rows:
+        yield pd.DataFrame(batch_rows, columns=MOVING_AVERAGE_COLUMNS)
+
 def update_trending_videos_database(trending_videos):
     # Add or update entries in current_trending_videos table
     # This function should be called after sending Slack alerts
@@ -136,101 +334,250 @@ def is_trending(group, min_increase_percentage=15):
     return percentage_increase >= min_increase_percentage and is_consistently_increasing
 
 
-def analyze_video(group):
+def classify_trend(group, trend_state=None):
+    # Derive new/up/down for a group that is already known to be trending.
+    # trend_state is the index from fetch_trend_state; without it the database is queried.
     video_id = group['video_id'].iloc[0]
-    if is_trending(group):
+    if trend_state is None:
         last_moving_average = get_last_moving_average(video_id)
-        current_moving_average = group['moving_average'].iloc[-1]
-
-        if last_moving_average is None:
-            return video_id, group, 'new'
-        elif current_moving_average > last_moving_average:
-            return video_id, group, 'up'
-        elif current_moving_average < last_moving_average:
-            return video_id, group, 'down'
+    else:
+        last_moving_average = trend_state.get(video_id, {}).get('last_moving_average')
+    # The stored value is a NUMERIC (Decimal) while the fetched one may be a float64;
+    # compare both as floats so an unchanged value is not taken for a decrease
+    current_moving_average = float(group['moving_average'].iloc[-1])
+
+    if last_moving_average is None:
+        return video_id, group, 'new'
+    last_moving_average = float(last_moving_average)
+    if current_moving_average > last_moving_average:
+        return video_id, group, 'up'
+    elif current_moving_average < last_moving_average:
+        return video_id, group, 'down'
+    return None
+
+
+def analyze_video(group):
+    if is_trending(group):
+        return classify_trend(group)
     return None
 
-def analyze_videos(df):
+def new_progress():
+    # Counters a run updates as it goes, e.g. for the Flask job status endpoint
+    return {'videos_scanned': 0, 'trending_found': 0,
+            'alerts_queued': 0, 'alerts_sent': 0, 'alerts_failed': 0,
+            'detector_hits': {name: 0 for name in TREND_DETECTORS}}
+
+
+def analyze_videos(df, progress=None, video_urls=None):
+    return analyze_video_batches([df], total=df['video_id'].nunique(), progress=progress, video_urls=video_urls)
+
+
+def fetch_tracked_video_ids(cursor):
+    cursor.execute('SELECT video_id FROM current_trending_videos')
+    return [video_id for video_id, in cursor.fetchall()]
+
+
+def iter_trend_alerts(batches, cursor, progress, pbar=None):
+    # Yield (video_id, group, trend_status) for every video in the batches that needs an alert
+    # Stateful detectors (hysteresis) need the videos tracked before this run
+    tracked = fetch_tracked_video_ids(cursor) if stateful_detectors(TREND_DETECTORS) else ()
+    for df in batches:
+        # Evaluate the trend rule for every video in one pass, then only walk the trending ones
+        with metrics.timer('classify'):
+            sorted_df, trend_results = detect_trends(df, detectors=TREND_DETECTORS, tracked=tracked)
+        candidates = trend_results[trend_results['is_trending']]
+        progress['trending_found'] += len(candidates)
+        metrics.increment('videos_scanned', len(trend_results))
+        metrics.increment('trending_found', len(candidates))
+        for name in TREND_DETECTORS:
+            progress['detector_hits'][name] += int(trend_results[name].sum())
+
+        # Load the stored state of every candidate in one round trip
+        trend_state = fetch_trend_state(cursor, candidates['video_id'].tolist())
+
+        for start, stop in zip(candidates['start'], candidates['stop']):
+            group_sorted = sorted_df.iloc[start:stop]
+
+            # Determine trend_status before checking if alert was already sent
+            trend_status_result = classify_trend(group_sorted, trend_state)
+            if trend_status_result:
+                video_id, group, trend_status = trend_status_result
+                if trend_state.get(video_id, {}).get('trend_status') == trend_status:
+                    print(f"Alert for video_id {video_id} with trend status {trend_status} already sent. Skipping.")
+                    continue
+                yield trend_status_result
+
+        if pbar is not None:
+            pbar.update(len(trend_results))  # Update the progress for each video in the batch
+        progress['videos_scanned'] += len(trend_results)
+
+
+def analyze_video_batches(batches, total=None, progress=None, video_urls=None):
+    # Analyze an iterable of DataFrames, each holding the complete rows of its videos.
+    # video_urls maps video_id -> video_url when the fetch already joined them.
     print("Analyzing videos for trending patterns...")
+    progress = new_progress() if progress is None else progress
+
+    # Check out a pooled database connection for the whole run
+    with get_connection() as conn:
+        cursor = conn.cursor()
+
+        # Initialize the progress bar
+        pbar = tqdm(total=total, desc="Analyzing Videos", unit="video")
+        trending_videos = deliver_trend_alerts(iter_trend_alerts(batches, cursor, progress, pbar), cursor, progress,
+                                               video_urls)
+        pbar.close()
+        cursor.close()
+    return trending_videos
+
+
+def deliver_trend_alerts(alerts, cursor, progress, video_urls=None):
+    # Queue an alert for each (video_id, group, trend_status) and record the new trend state.
+    # alerts may be a generator, in which case delivery overlaps with the analysis producing it.
+    # Videos missing from video_urls have their URL looked up when the alert is sent.
+    video_urls = video_urls or {}
     trending_videos = []
 
-    # Establish database connection
-    conn = psycopg2.connect(**db_params)
-    cursor = conn.cursor()
-
-    # Initialize the progress bar
-    pbar = tqdm(total=len(df['video_id'].unique()), desc="Analyzing Videos", unit="video")
-    for video_id, group in df.groupby('video_id'):
-        group_sorted = group.sort_values(by='date', ascending=True)
-        
-        # Determine trend_status before checking if alert was already sent
-        trend_status_result = analyze_video(group_sorted)
-        if trend_status_result:
+    # Alerts are rendered, uploaded and posted by worker threads while the analysis carries on
+    dispatcher = AlertDispatcher(send_slack_alert, max_workers=ALERT_WORKERS,
+                                 max_pending=ALERT_QUEUE_SIZE, timeout=ALERT_TIMEOUT, stats=progress)
+
+    # Trend state changes are collected and written in one transaction at the end of the run
+    state_writer = TrendStateWriter()
+
+    try:
+        for trend_status_result in alerts:
             video_id, group, trend_status = trend_status_result
-            if alert_already_sent(cursor, video_id, trend_status):
-                print(f"Alert for video_id {video_id} with trend status {trend_status} already sent. Skipping.")
-                continue
-            # If alert not sent, append to trending_videos and send alert
             trending_videos.append(trend_status_result)
-            send_slack_alert(video_id, group, trend_status)  # Send alert for each trending video
-            update_trending_videos_database(cursor, video_id, group['moving_average'].iloc[-1], trend_status)
-
-        pbar.update(1)  # Update the progress for each video
-    pbar.close()
-    cursor.close()
-    conn.close()
-
-def check_previous_trends(trending_videos):
-    # Get a list of all previously trending video IDs
-    previously_trending = {video_id for video_id, _, _ in trending_videos}
-    df_current_trends = fetch_current_trending_videos()
-    
-    # Check if they are still trending
-    for _, row in df_current_trends.iterrows():
-        video_id = row['video_id']
-        if video_id not in previously_trending:
-            # This video was previously trending but wasn't updated just now
-            group = fetch_video_data(video_id)
-            if group is not None and not is_trending(group):
-                # Send Slack notification that the video is no longer trending
-                title = group['video_title'].iloc[0]
-                message_text = f"Video *{title}* is no longer trending."
-                slack_message = {
-                    "text": message_text,
-                }
-                response = requests.post(slack_webhook_url, json=slack_message, headers={'Content-Type': 'application/json'})
-                # Handle the response
+            # Queue an alert for each trending video
+            dispatcher.submit(video_id, group, trend_status, video_urls.get(video_id))
+    finally:
+        results = dispatcher.close()
+
+    # Only alerts that reached Slack are recorded; failed and timed-out ones are not
+    # marked as sent, so the next run alerts them again
+    for video_id, group, trend_status, _ in results['sent']:
+        state_writer.add(video_id, group['moving_average'].iloc[-1], trend_status)
+    if results['failed'] or results['timed_out']:
+        print(f"{len(results['failed'])} alerts failed and {len(results['timed_out'])} timed out; "
+              f"they will be retried on the next run.")
+    try:
+        state_writer.apply(cursor)
+    except Exception as e:
+        print(f"An error occurred while updating the trending videos: {e}")
+    # Hand this run's alert and error events to the sinks now rather than on the next interval
+    metrics.flush()
+    return trending_videos
+
+
+def analyze_shard(shard, shards, last_n=None):
+    # Worker process side of a sharded run: fetch and analyze one shard, but leave
+    # alerts and state writes to the parent so they happen once
+    # The parent merges this worker's metrics, so it must not publish them to the store too
+    metrics.configure(metrics.sinks)
+    progress = new_progress()
+    df, videos = fetch_compact_moving_averages(last_n, shard=(shard, shards))
+    # drain, not snapshot: a worker process may analyze several shards, and the parent adds up each return
+    if df is None or df.empty:
+        return [], progress, metrics.drain(), {}
+    with get_cursor() as cursor:
+        alerts = list(iter_trend_alerts([df], cursor, progress))
+    video_urls = {video_id: videos.at[video_id, 'video_url'] for video_id, _, _ in alerts}
+    return alerts, progress, metrics.drain(), video_urls
+
+
+def run_sharded(shard_ids, shards, workers=None, last_n=None, progress=None):
+    # Split the catalog into `shards` by hash of video_id and analyze shard_ids
+    # in parallel worker processes, then send the merged alerts from this process
+    progress = new_progress() if progress is None else progress
+    workers = workers or min(len(shard_ids), os.cpu_count() or 1)
+    print(f"Analyzing shards {shard_ids} of {shards} with {workers} processes...")
+    alerts, video_urls = [], {}
+    # spawn, not fork: the parent may already hold pooled connections and threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(analyze_shard, shard, shards, last_n): shard for shard in shard_ids}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Analyzing Shards", unit="shard"):
+            shard_alerts, shard_progress, shard_metrics, shard_video_urls = future.result()
+            alerts.extend(shard_alerts)
+            video_urls.update(shard_video_urls)
+            metrics.merge(shard_metrics)
+            for key in ('videos_scanned', 'trending_found'):
+                progress[key] += shard_progress[key]
+            for name, hits in shard_progress['detector_hits'].items():
+                progress['detector_hits'][name] += hits
+
+    with get_cursor() as cursor:
+        return deliver_trend_alerts(alerts, cursor, progress, video_urls)
+
+def check_previous_trends(trending_videos=(), window=TREND_WINDOW):
+    """
+    Sweep current_trending_videos for videos that are no longer trending.
+
+    The recent windows of every tracked video (except those alerted in this run) are
+    loaded in one query and run through the trend rule in one vectorized pass. The
+    videos that fail it get one digest on the Slack webhook and are removed from
+    current_trending_videos; the delete is only committed once the digest was sent,
+    so a failed send leaves them for the next sweep. Returns the removed video_ids.
+    """
+    alerted = list({video_id for video_id, _, _ in trending_videos})
+    with get_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+            SELECT video_title, video_id, date, moving_average
+            FROM (
+                SELECT s.video_title, s.video_id, s.date, s.moving_average,
+                       ROW_NUMBER() OVER (PARTITION BY s.video_id ORDER BY s.date DESC) AS row_number
+                FROM video_view_statistics s
+                JOIN current_trending_videos c USING (video_id)
+                WHERE NOT (s.video_id = ANY(%s))
+            ) recent
+            WHERE row_number <= %s
+            ''', (alerted, window))
+            df = pd.DataFrame(cursor.fetchall(), columns=MOVING_AVERAGE_COLUMNS)
+            if df.empty:
+                return []
+
+            sorted_df, trend_results = detect_trends(df, window=window)
+            ended = trend_results[~trend_results['is_trending']]
+            if ended.empty:
+                return []
+            video_ids = ended['video_id'].tolist()
+            titles = sorted_df['video_title'].to_numpy()[ended['start'].to_numpy()]
+
+            try:
+                cursor.execute('DELETE FROM current_trending_videos WHERE video_id = ANY(%s)', (video_ids,))
+                # Send Slack notification that the videos are no longer trending, as few messages as possible
+                get_slack_client().post_webhook_lines(
+                    [f"Video *{title}* is no longer trending." for title in titles],
+                    header=f"{len(video_ids)} videos are no longer trending:")
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"An error occurred while sending the no longer trending digest: {e}")
+                return []
+    metrics.increment('no_longer_trending', len(video_ids))
+    return video_ids
 
 
 def not_already_trending(video_id):
     try:
-        conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
-        query = 'SELECT video_id FROM current_trending_videos WHERE video_id = %s'
-        cursor.execute(query, (video_id,))
-        return cursor.fetchone() is None
+        with get_cursor() as cursor:
+            query = 'SELECT video_id FROM current_trending_videos WHERE video_id = %s'
+            cursor.execute(query, (video_id,))
+            return cursor.fetchone() is None
     except Exception as e:
         print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
 
 def get_last_moving_average(video_id):
     # Fetch the last moving average from the database for the given video_id
     try:
-        conn = psycopg2.connect(**db_params)
-        cursor = conn.cursor()
-        query = 'SELECT last_moving_average FROM current_trending_videos WHERE video_id = %s'
-        cursor.execute(query, (video_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
+        with get_cursor() as cursor:
+            query = 'SELECT last_moving_average FROM current_trending_videos WHERE video_id = %s'
+            cursor.execute(query, (video_id,))
+            result = cursor.fetchone()
+            return result[0] if result else None
     except Exception as e:
         print(f"An error occurred while fetching the last moving average: {e}")
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
 
 def update_trending_videos_database(cursor, video_id, last_moving_average, trend_status):
     # Update or insert the video trend status and last moving average in the database
@@ -253,144 +600,234 @@ def update_trending_videos_database(cursor, video_id, last_moving_average, trend
         print(f"An error occurred while updating the trending videos: {e}")
 
 
-def upload_to_s3(bucket_name, s3_file_name, data):
-    s3 = boto3.client('s3',
-                      aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                      aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'))
-    try:
-        s3.upload_fileobj(data, bucket_name, s3_file_name)
-        return f"https://{bucket_name}.s3.amazonaws.com/{s3_file_name}"
-    except NoCredentialsError:
-        print("Credentials not available")
-        return None
-    
- 
- 
-def send_slack_alert(video_id, group, trend_status):
-    title, video_url, image_public_url, message_text = None, None, None, None
+def upload_chart_to_s3(bucket_name, s3_file_name, png):
+    # Content-addressed upload: skip it when the object is already in the bucket
+    return get_uploader().upload_chart(bucket_name, s3_file_name, png)
+
+
+def build_slack_message(title, video_url, image_public_url, trend_status):
+    # Returns (message_text, slack_message payload for chat.postMessage)
+    if trend_status == 'new':
+        message_text = f"New Trending Video Alert: *{title}*"
+    elif trend_status == 'up':
+        message_text = f"Continuing to Trend Upwards: *{title}*"
+    else:
+        message_text = f"Starting to Trend Downwards: *{title}*"
+
+    # Prepare the Slack message payload
+    slack_message = {
+        "channel": "C06JLDF1MNH",  # Replace with your actual channel ID
+        "text": f"Trending Alert: *{title}*",
+        "attachments": [
+            {
+                "fallback": "You are unable to choose a game",
+                "callback_id": "modal_open",
+                "color": "#3AA3E3",
+                "attachment_type": "default",
+                "actions": [
+                    {
+                        "name": "details",
+                        "text": "View Details",
+                        "type": "button",
+                        "value": "view_details",
+                        "action_id": "open_modal"
+                    }
+                ]
+            },
+            {
+                "title": title,
+                "title_link": video_url,
+                "image_url": image_public_url
+            }
+        ]
+    }
+    return message_text, slack_message
+
+
+def send_slack_alert(video_id, group, trend_status, video_url=None):
+    # video_url is looked up here unless the fetch already joined it in
+    from charts import render_chart
+    title, image_public_url, message_text = None, None, None
     try:
         title = group['video_title'].iloc[0]
-        video_url = get_video_url(video_id)
-        graph_image = plot_moving_average(group, title, show=False)
+        if video_url is None:
+            video_url = get_video_url(video_id)
+        with metrics.timer('render'):
+            chart_digest, graph_image = render_chart(group, title)
     except Exception as e:
-        log_error_to_flask(e, video_id, "Error while preparing alert data")
-        return  # Stop further processing if we encounter an error here
+        record_error(e, video_id, "Error while preparing alert data")
+        return False  # Stop further processing if we encounter an error here
 
     try:
-        # Generate a filename for the image
-        s3_file_name = f"{video_id}_trend.png"
-        
-        # Upload the image to cloud storage and get the public URL
-        image_public_url = upload_to_s3('graphlinestorage', s3_file_name, graph_image)
+        # Pre-warm the comments cache so "View Details" on this alert opens instantly (inside the app only)
+        warm_for_alert(video_url)
     except Exception as e:
-        log_error_to_flask(e, video_id, "Error while uploading image to S3")
-        return  # Stop further processing if we encounter an error here
+        print(f"An error occurred while pre-warming comments for {video_id}: {e}")
 
     try:
-        # Construct the message based on the trend status
-        if trend_status == 'new':
-            message_text = f"New Trending Video Alert: *{title}*"
-        elif trend_status == 'up':
-            message_text = f"Continuing to Trend Upwards: *{title}*"
-        else:
-            message_text = f"Starting to Trend Downwards: *{title}*"
-
-        # Prepare the Slack message payload
-        slack_message = {
-            "channel": "C06JLDF1MNH",  # Replace with your actual channel ID
-            "text": f"Trending Alert: *{title}*",
-            "attachments": [
-                {
-                    "fallback": "You are unable to choose a game",
-                    "callback_id": "modal_open",
-                    "color": "#3AA3E3",
-                    "attachment_type": "default",
-                    "actions": [
-                        {
-                            "name": "details",
-                            "text": "View Details",
-                            "type": "button",
-                            "value": "view_details",
-                            "action_id": "open_modal"
-                        }
-                    ]
-                },
-                {
-                    "title": title,
-                    "title_link": video_url,
-                    "image_url": image_public_url
-                }
-            ]
-        }
-
+        # Charts are stored under the hash of their content, so an unchanged chart is only uploaded once
+        s3_file_name = f"charts/{chart_digest}.png"
 
+        # Upload the image to cloud storage and get the public URL
+        with metrics.timer('upload'):
+            image_public_url = upload_chart_to_s3('graphlinestorage', s3_file_name, graph_image)
     except Exception as e:
-        log_error_to_flask(e, video_id, "Error while constructing Slack message")
-        return  # Stop further processing if we encounter an error here
+        record_error(e, video_id, "Error while uploading image to S3")
+        return False  # Stop further processing if we encounter an error here
 
     try:
-        # Send the message using the Slack API
-        headers = {'Authorization': f'Bearer {SLACK_BOT_TOKEN}', 'Content-Type': 'application/json'}
-        response = requests.post('https://slack.com/api/chat.postMessage', headers=headers, json=slack_message)
-        # Check for successful response
-        if response.status_code == 200:
-            log_alert_to_flask({'text': message_text, 'video_id': video_id, 'trend_status': trend_status})
-        else:
-            raise ValueError(f"Request to Slack API returned an error {response.status_code}, the response is:\n{response.text}")
+        message_text, slack_message = build_slack_message(title, video_url, image_public_url, trend_status)
     except Exception as e:
-        # Log the exception to the Flask app
-        log_error_to_flask(e, video_id, "Error while sending Slack message")
-        print(f"An error occurred while sending the Slack alert: {e}")
-
+        record_error(e, video_id, "Error while constructing Slack message")
+        return False  # Stop further processing if we encounter an error here
 
-def log_error_to_flask(exception, video_id, context):
-    # Replace with your Flask app's URL when using ngrok
-    flask_url = 'https://cf21-154-222-6-15.ngrok-free.app/error-logging'  
-    error_data = {
-        'error': str(exception),
-        'video_id': video_id,
-        'context': context
-    }
     try:
-        response = requests.post(flask_url, json=error_data)
-        if response.status_code != 200:
-            print(f"Failed to log error to Flask app: {response.status_code}, {response.text}")
-    except requests.exceptions.RequestException as e:
-        print(f"An exception occurred when trying to log error to Flask app: {e}")
-
-
-def log_alert_to_flask(alert_data):
-    # Assuming your Flask app's logging endpoint is '/alert-sent' and it is running on localhost:5000
-    flask_url = 'https://cf21-154-222-6-15.ngrok-free.app/alert-sent'  # Replace with your Flask app's URL when using ngrok
-    response = requests.post(flask_url, json=alert_data)
-    if response.status_code == 200:
-        print("Alert log sent to Flask app.")
+        # Send the message using the Slack API; the shared client waits out rate limits and retries
+        with metrics.timer('post'):
+            get_slack_client().post_message(slack_message)
+        record_alert({'text': message_text, 'video_id': video_id, 'trend_status': trend_status})
+        return True
+    except Exception as e:
+        # Record the exception for the metrics sinks
+        record_error(e, video_id, "Error while sending Slack message")
+        print(f"An error occurred while sending the Slack alert: {e}")
+        return False
+
+
+def record_error(exception, video_id, context):
+    # Count the error and queue an event for the metrics sinks; with the http sink it
+    # reaches the Flask app's /error-logging endpoint in the next batch
+    metrics.increment('alert_errors')
+    metrics.event('error', error=str(exception), video_id=video_id, context=context)
+
+
+def record_alert(alert_data):
+    # Same for a delivered alert, which the http sink posts to /alert-sent
+    metrics.increment('alerts_posted')
+    metrics.event('alert', **alert_data)
+
+# Postgres advisory lock held by every run, in every process (CLI, gunicorn workers, other hosts).
+# Sharded runs hold it shared plus an exclusive lock per shard, so hosts can split one run.
+PIPELINE_LOCK_KEY = int(os.environ.get('PIPELINE_LOCK_KEY', 7261600100))
+PIPELINE_SHARD_LOCK_CLASS = int(os.environ.get('PIPELINE_SHARD_LOCK_CLASS', 72616))
+
+
+def pipeline_locks(mode, shard_spec=None):
+    if mode != 'sharded':
+        return [(PIPELINE_LOCK_KEY, False)]
+    shard_ids, shards = parse_shard_spec(shard_spec)
+    return [(PIPELINE_LOCK_KEY, True)] + [((PIPELINE_SHARD_LOCK_CLASS, shards << 16 | shard), False)
+                                          for shard in shard_ids]
+
+
+def run_pipeline(mode='full', progress=None, last_n=None, batch_size=5000, shard_spec=None, workers=None,
+                 source='statistics', refresh_snapshot=False, sweep=False, rebuild_window=False):
+    """
+    One analysis run, and with sweep=True the no-longer-trending sweep after it.
+
+    Runs read current_trending_videos before writing it, so two at once would send the
+    same alerts twice. Only one run goes at a time across every process: when another
+    one holds the pipeline lock this trigger is merged into it, progress['merged'] is
+    set and None is returned.
+    """
+    progress = new_progress() if progress is None else progress
+    with advisory_lock(*pipeline_locks(mode, shard_spec)) as acquired:
+        if not acquired:
+            print("Another run is in progress; merged into it.")
+            progress['merged'] = True
+            return None
+        trending_videos = run_analysis(mode, progress, last_n, batch_size, shard_spec, workers, source,
+                                       refresh_snapshot, rebuild_window)
+        if sweep:
+            removed = check_previous_trends(trending_videos or [])
+            print(f"{len(removed)} videos are no longer trending.")
+        return trending_videos
+
+
+def run_analysis(mode='full', progress=None, last_n=None, batch_size=5000, shard_spec=None, workers=None,
+                 source='statistics', refresh_snapshot=False, rebuild_window=False):
+    # One full analysis run; mode is 'full', 'stream', 'sharded' or 'incremental'.
+    # source='window' makes a full run read the precomputed video_recent_windows table,
+    # recomputed for every video first with rebuild_window=True,
+    # source='snapshot' the local columnar snapshot topped up with the newer rows,
+    # source='pushdown' only the rows of the videos the rule already selected in Postgres.
+    # The extra TREND_DETECTORS may need more rows per video than the trend rule
+    if last_n is not None:
+        last_n = max(last_n, FETCH_WINDOW)
+    if mode == 'sharded':
+        shard_ids, shards = parse_shard_spec(shard_spec)
+        return run_sharded(shard_ids, shards, workers, last_n, progress)
+
+    if mode == 'incremental':
+        return run_incremental(last_n or FETCH_WINDOW, progress)
+
+    if mode == 'stream':
+        return analyze_video_batches(iter_video_batches(batch_size, last_n), progress=progress)
+
+    video_urls = None
+    if source == 'window':
+        df_moving_averages = fetch_recent_window_frame(last_n, rebuild=rebuild_window)
+    elif source == 'pushdown':
+        df_moving_averages = fetch_pushdown_frame(last_n)
+    elif source == 'snapshot':
+        with metrics.timer('fetch'):
+            df_moving_averages = fetch_snapshot_frame(refresh=refresh_snapshot)
     else:
-        print(f"Failed to log alert: {response.status_code}, {response.text}")
-
-def plot_moving_average(group, title, show=True):
-    plt.figure(figsize=(10, 6))
-    plt.plot(group['date'], group['moving_average'], marker='o', linestyle='-', color='b')
-    plt.title(title)
-    plt.xlabel('Date')
-    plt.ylabel('Moving Average of Views')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-
-    if show:
-        plt.show()
+        df_moving_averages, videos = fetch_compact_moving_averages(last_n)
+        if videos is not None:
+            video_urls = videos['video_url'].to_dict()
+    if df_moving_averages is not None and not df_moving_averages.empty:
+        return analyze_videos(df_moving_averages, progress, video_urls)
+    print("No moving averages found to analyze.")
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect trending videos and send Slack alerts.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream statistics through a server-side cursor instead of loading the whole table")
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help="Videos analyzed per batch in --stream mode")
+    parser.add_argument('--last-n', type=int, default=None,
+                        help="Only fetch the N most recent days of each video")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only analyze videos with statistics newer than the last incremental run")
+    parser.add_argument('--shards', metavar='SPEC', default=None,
+                        help="Sharded run over worker processes: N for all N shards, or K/N, K1-K2/N, K1,K2/N "
+                             "for part of them (e.g. one part per host)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes for --shards (default: one per shard, up to the CPU count)")
+    parser.add_argument('--source', choices=['statistics', 'window', 'snapshot', 'pushdown'], default='statistics',
+                        help="Read the raw statistics, the per-video recent window table (refreshed first), "
+                             "the local columnar snapshot plus the rows added since it was taken, "
+                             "or only the trending candidates selected by the rule in SQL")
+    parser.add_argument('--refresh-snapshot', action='store_true',
+                        help="With --source snapshot, ignore the local snapshot and download everything again")
+    parser.add_argument('--rebuild-window', action='store_true',
+                        help="With --source window, recompute every video's window instead of only the recent "
+                             "ones, e.g. after back-filling older dates or changing RECENT_WINDOW_SIZE")
+    parser.add_argument('--sweep', action='store_true',
+                        help="After the run, post one digest of tracked videos that are no longer trending "
+                             "and stop tracking them")
+    parser.add_argument('--check-pushdown', action='store_true',
+                        help="Compare the SQL and Python versions of the trend rule on the full table, then exit")
+    args = parser.parse_args()
+
+    if args.check_pushdown:
+        with get_cursor() as cursor:
+            parity = check_parity(cursor)
+        print(json.dumps(parity, indent=2))
+        sys.exit(0 if parity['match'] else 1)
+
+    if args.shards:
+        mode = 'sharded'
     else:
-        img_buf = BytesIO()
-        plt.savefig(img_buf, format='png')
-        plt.close()
-        img_buf.seek(0)
-        return img_buf
-
+        mode = 'incremental' if args.incremental else 'stream' if args.stream else 'full'
+    run_pipeline(mode, last_n=args.last_n, batch_size=args.batch_size, shard_spec=args.shards, workers=args.workers,
+                 source=args.source, refresh_snapshot=args.refresh_snapshot, sweep=args.sweep,
+                 rebuild_window=args.rebuild_window)
 
 
 # Main flow
-df_moving_averages = fetch_moving_averages()
-if df_moving_averages is not None and not df_moving_averages.empty:
-    analyze_videos(df_moving_averages)
-else:
-    print("No moving averages found to analyze.")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,358 @@
+import atexit
+import datetime
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+
+# Where structured events go: any of stdout, file and http, comma separated
+METRICS_SINKS = os.environ.get('METRICS_SINKS')
+METRICS_LOG_FILE = os.environ.get('METRICS_LOG_FILE', 'trend_events.log')
+# Base URL of the Flask app that receives alert and error events, e.g. https://<name>.ngrok-free.app
+METRICS_HTTP_URL = os.environ.get('METRICS_HTTP_URL')
+LOG_TIMEOUT = float(os.environ.get('LOG_TIMEOUT', 5))
+# Seconds between background flushes, events that trigger an early flush, and events kept before dropping
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+METRICS_BATCH_SIZE = int(os.environ.get('METRICS_BATCH_SIZE', 100))
+METRICS_BUFFER_SIZE = int(os.environ.get('METRICS_BUFFER_SIZE', 10000))
+
+# Where processes publish their counters and timings for GET /metrics: postgres or none
+METRICS_STORE = os.environ.get('METRICS_STORE', 'postgres')
+# Seconds a process' published counters are kept after its last update, e.g. of finished CLI runs
+METRICS_RETENTION = float(os.environ.get('METRICS_RETENTION', 7 * 24 * 3600))
+
+# Upper bounds in seconds of the timing histogram buckets
+TIMING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class StdoutSink:
+    name = 'stdout'
+
+    def send(self, events):
+        for event in events:
+            print(json.dumps(event, default=str))
+        sys.stdout.flush()
+
+
+class LogFileSink:
+    name = 'file'
+
+    def __init__(self, path=METRICS_LOG_FILE):
+        self.path = path
+
+    def send(self, events):
+        # One JSON object per line
+        with open(self.path, 'a') as f:
+            for event in events:
+                f.write(json.dumps(event, default=str) + '\n')
+
+
+class HttpSink:
+    """
+    Posts alert and error events to the Flask app's /alert-sent and /error-logging
+    endpoints, one request per endpoint and batch. Other event types are skipped.
+    """
+    name = 'http'
+    routes = {'alert': '/alert-sent', 'error': '/error-logging'}
+
+    def __init__(self, base_url=METRICS_HTTP_URL, timeout=LOG_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._session = None
+
+    def send(self, events):
+        import requests
+        if self._session is None:
+            self._session = requests.Session()
+        for event_type, path in self.routes.items():
+            batch = [event for event in events if event['type'] == event_type]
+            if not batch:
+                continue
+            response = self._session.post(self.base_url + path, json=batch, timeout=self.timeout)
+            if response.status_code != 200:
+                raise ValueError(f"{path} returned {response.status_code}: {response.text}")
+
+
+def sinks_from_env():
+    names = METRICS_SINKS.split(',') if METRICS_SINKS is not None else ['http' if METRICS_HTTP_URL else 'stdout']
+    sinks = []
+    for name in filter(None, (name.strip() for name in names)):
+        if name == 'stdout':
+            sinks.append(StdoutSink())
+        elif name == 'file':
+            sinks.append(LogFileSink())
+        elif name == 'http':
+            if METRICS_HTTP_URL:
+                sinks.append(HttpSink())
+            else:
+                print("METRICS_HTTP_URL is not set, the http metrics sink is disabled.")
+        else:
+            raise ValueError(f"Unknown metrics sink {name!r}")
+    return sinks
+
+
+class PostgresMetricsStore:
+    """
+    The counters and timings of every process in the pipeline_metrics table, one row
+    per process, so GET /metrics adds up CLI runs and all gunicorn workers instead of
+    reporting only the worker that serves the request.
+    """
+
+    def __init__(self, retention=METRICS_RETENTION):
+        self.retention = retention
+        self.source = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._table_ready = False
+
+    def _cursor(self):
+        # Only loaded once something is published, so importing metrics stays cheap
+        from db import get_cursor
+        return get_cursor(commit=True)
+
+    def _ensure_table(self, cursor):
+        if not self._table_ready:
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pipeline_metrics (
+                source TEXT PRIMARY KEY,
+                snapshot JSONB NOT NULL,
+                updated_at TIMESTAMP NOT NULL DEFAULT now()
+            );
+            ''')
+            self._table_ready = True
+
+    def publish(self, snapshot):
+        with self._cursor() as cursor:
+            self._ensure_table(cursor)
+            cursor.execute('''
+            INSERT INTO pipeline_metrics (source, snapshot, updated_at) VALUES (%s, %s, now())
+            ON CONFLICT (source) DO UPDATE SET snapshot = EXCLUDED.snapshot, updated_at = EXCLUDED.updated_at;
+            ''', (self.source, json.dumps(snapshot, default=str)))
+            cursor.execute('DELETE FROM pipeline_metrics WHERE updated_at < now() - make_interval(secs => %s)',
+                           (self.retention,))
+
+    def load(self, exclude=None):
+        # Published snapshots, except the one of `exclude` (a source)
+        with self._cursor() as cursor:
+            self._ensure_table(cursor)
+            cursor.execute('SELECT snapshot FROM pipeline_metrics WHERE source IS DISTINCT FROM %s', (exclude,))
+            return [snapshot for snapshot, in cursor.fetchall()]
+
+
+def store_from_env():
+    if METRICS_STORE == 'postgres':
+        return PostgresMetricsStore()
+    if METRICS_STORE == 'none':
+        return None
+    raise ValueError(f"Unknown metrics store {METRICS_STORE!r}")
+
+
+def new_histogram():
+    return {'count': 0, 'sum': 0.0, 'min': None, 'max': None, 'buckets': [0] * len(TIMING_BUCKETS)}
+
+
+def merge_snapshot(counters, timings, snapshot):
+    # Add the counters and timings of a snapshot() into the counters and timings dicts
+    for name, value in snapshot['counters'].items():
+        counters[name] = counters.get(name, 0) + value
+    for stage, other in snapshot['timings'].items():
+        histogram = timings.get(stage)
+        if histogram is None:
+            histogram = timings[stage] = new_histogram()
+        histogram['count'] += other['count']
+        histogram['sum'] += other['sum']
+        for key, pick in (('min', min), ('max', max)):
+            if other[key] is not None:
+                histogram[key] = other[key] if histogram[key] is None else pick(histogram[key], other[key])
+        histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+
+
+def timings_report(timings):
+    # Histograms as plain JSON-ready dicts with their mean; buckets are per bucket, not cumulative
+    return {stage: dict(histogram, buckets=list(histogram['buckets']),
+                        mean=histogram['sum'] / histogram['count'] if histogram['count'] else None)
+            for stage, histogram in timings.items()}
+
+
+class Metrics:
+    """
+    In-process counters, per-stage timing histograms and a buffer of structured events.
+
+    Recording only takes a lock and updates a dict, so it is cheap enough for the alert
+    path. Events are handed to the sinks by a background thread every flush_interval
+    seconds, or sooner once batch_size are waiting; nothing on the hot path waits for I/O.
+    When the buffer is full the oldest events are dropped and counted in events_dropped.
+    With a store, each flush also publishes the counters and timings when they changed,
+    for shared_snapshot() in other processes.
+    """
+
+    def __init__(self, sinks=(), flush_interval=METRICS_FLUSH_INTERVAL, batch_size=METRICS_BATCH_SIZE,
+                 buffer_size=METRICS_BUFFER_SIZE, store=None):
+        self.sinks = list(sinks)
+        self.store = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._events = deque(maxlen=buffer_size)
+        self._wake = threading.Event()
+        self._flusher = None
+        # Bumped on every counter or timing change; publishing is skipped while it stands still
+        self._version = 0
+        self._published_version = 0
+        atexit.register(self.flush)
+
+    def configure(self, sinks, store=None):
+        # Swap the sinks and the store, e.g. to silence events in benchmarks; buffered events go to the new sinks
+        self.sinks = list(sinks)
+        self.store = store
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+            self._version += 1
+        if self.store is not None:
+            self._ensure_flusher()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self._version += 1
+            histogram = self._timings.get(stage)
+            if histogram is None:
+                histogram = self._timings[stage] = new_histogram()
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['min'] = seconds if histogram['min'] is None else min(histogram['min'], seconds)
+            histogram['max'] = seconds if histogram['max'] is None else max(histogram['max'], seconds)
+            for index, bound in enumerate(TIMING_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+        if self.store is not None:
+            self._ensure_flusher()
+
+    @contextmanager
+    def timer(self, stage):
+        # Time the block into the stage's histogram, whether it succeeds or raises
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def event(self, event_type, **fields):
+        record = {'type': event_type, 'time': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        record.update(fields)
+        with self._lock:
+            if len(self._events) == self._events.maxlen:
+                self._counters['events_dropped'] = self._counters.get('events_dropped', 0) + 1
+                self._version += 1
+            self._events.append(record)
+            pending = len(self._events)
+        self._ensure_flusher()
+        if pending >= self.batch_size:
+            self._wake.set()
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        # Hand every buffered event to each sink. A failing sink is counted and reported,
+        # but its batch is not retried, so a dead endpoint cannot back events up.
+        with self._flush_lock:
+            with self._lock:
+                events = list(self._events)
+                self._events.clear()
+            for sink in self.sinks if events else ():
+                try:
+                    sink.send(events)
+                except Exception as e:
+                    self.increment(f'sink_errors.{sink.name}')
+                    print(f"An error occurred while flushing {len(events)} events to the {sink.name} sink: {e}")
+            if events:
+                self.increment('events_flushed', len(events))
+            self._publish()
+            return len(events)
+
+    def _publish(self):
+        # Write the counters and timings to the store when they changed since the last write
+        store = self.store
+        with self._lock:
+            version = self._version
+            empty = not self._counters and not self._timings
+        if store is None or version == self._published_version or empty:
+            return
+        try:
+            store.publish(self.snapshot())
+            self._published_version = version
+        except Exception as e:
+            print(f"An error occurred while publishing metrics: {e}")
+
+    def merge(self, snapshot):
+        # Add the counters and timings of another process' snapshot(), e.g. a shard worker
+        with self._lock:
+            merge_snapshot(self._counters, self._timings, snapshot)
+            self._version += 1
+
+    def drain(self):
+        # snapshot() and start counting from zero, e.g. a shard worker handing its share to the parent
+        with self._lock:
+            snapshot = self._snapshot()
+            self._counters, self._timings = {}, {}
+            self._version += 1
+        return snapshot
+
+    def snapshot(self):
+        # Counters and timings as plain JSON-ready dicts; buckets are per bucket, not cumulative
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return {
+            'counters': dict(self._counters),
+            'timings': timings_report(self._timings),
+            'bucket_bounds': [str(bound) for bound in TIMING_BUCKETS],
+            'events_buffered': len(self._events),
+            'sinks': [sink.name for sink in self.sinks],
+            'uptime_seconds': time.time() - self.started_at,
+        }
+
+    def shared_snapshot(self):
+        """
+        snapshot() with the counters and timings every other process published to the
+        store added in: CLI and sharded runs, and the other gunicorn workers. processes
+        counts the snapshots added up. Falls back to this process alone without a store.
+        """
+        snapshot = self.snapshot()
+        others = []
+        if self.store is not None:
+            try:
+                others = self.store.load(exclude=self.store.source)
+            except Exception as e:
+                print(f"An error occurred while loading the published metrics: {e}")
+        counters, timings = {}, {}
+        for other in [snapshot] + others:
+            merge_snapshot(counters, timings, other)
+        return dict(snapshot, counters=counters, timings=timings_report(timings), processes=1 + len(others))
+
+
+# The process-wide instance used by the pipeline and published for the Flask /metrics endpoint
+metrics = Metrics(sinks_from_env(), store=store_from_env())
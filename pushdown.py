@@ -0,0 +1,101 @@
+import pandas as pd
+
+from trends import MIN_INCREASE_PERCENTAGE, TREND_WINDOW, detect_trends
+
+
+# The window functions below read each video's rows in (video_id, date) order; with this
+# index Postgres can walk it instead of sorting the whole table, and the candidates' rows
+# are fetched by index lookups
+INDEX_DDL = 'CREATE INDEX IF NOT EXISTS video_view_statistics_video_id_date_idx ON video_view_statistics (video_id, date)'
+
+
+def candidates_query(window=TREND_WINDOW):
+    """
+    SQL for the video_ids that pass the trend rule, evaluated inside Postgres.
+
+    Same rule as trends.consistent_increase: the newest row and the window - 1 rows
+    before it strictly increasing, and an increase of at least
+    %(min_increase_percentage)s percent from the oldest to the newest. Values are
+    compared as NUMERIC, exactly like is_trending on Decimal rows and detect_trends
+    after its exact re-check near the threshold, and an oldest value of 0 counts as an
+    infinite increase, like numpy's division by zero.
+    """
+    if window < 2:
+        raise ValueError("The trend window needs at least 2 days")
+    oldest = f'm{window - 1}'
+    lags = ''.join(f',\n               LAG(moving_average, {k}) OVER w AS m{k}' for k in range(1, window))
+    increasing = '\n      AND '.join(f'm{k} < m{k - 1}' for k in range(1, window))
+    return f'''
+    SELECT video_id
+    FROM (
+        SELECT video_id, moving_average AS m0{lags},
+               LEAD(date) OVER w AS next_date
+        FROM (
+            SELECT video_id, date, moving_average::numeric AS moving_average
+            FROM video_view_statistics
+        ) s
+        WINDOW w AS (PARTITION BY video_id ORDER BY date)
+    ) lagged
+    WHERE next_date IS NULL
+      AND {increasing}
+      -- Postgres sorts NaN above every number, numpy compares it as false
+      AND m0 <> 'NaN'::numeric
+      AND CASE WHEN {oldest} = 0 THEN true
+               ELSE (m0 - {oldest}) / {oldest} * 100 >= %(min_increase_percentage)s::numeric END
+    '''
+
+
+def pushdown_query(window=TREND_WINDOW, last_n=None):
+    # Rows of the trending candidates only, grouped by video_id, newest first.
+    # With last_n only the last_n most recent rows of each candidate are returned (the chart window).
+    candidates = candidates_query(window)
+    if last_n is None:
+        return f'''
+        WITH candidates AS ({candidates})
+        SELECT s.video_title, s.video_id, s.date, s.moving_average
+        FROM video_view_statistics s
+        JOIN candidates USING (video_id)
+        ORDER BY s.video_id, s.date DESC
+        '''
+    return f'''
+    WITH candidates AS ({candidates})
+    SELECT video_title, video_id, date, moving_average
+    FROM (
+        SELECT s.video_title, s.video_id, s.date, s.moving_average,
+               ROW_NUMBER() OVER (PARTITION BY s.video_id ORDER BY s.date DESC) AS row_number
+        FROM video_view_statistics s
+        JOIN candidates USING (video_id)
+    ) recent
+    WHERE row_number <= %(last_n)s
+    ORDER BY video_id, date DESC
+    '''
+
+
+def fetch_pushdown_candidates(cursor, min_increase_percentage=MIN_INCREASE_PERCENTAGE, window=TREND_WINDOW,
+                              last_n=None):
+    # The candidates' rows as a DataFrame in the fetch_moving_averages layout
+    cursor.execute(pushdown_query(window, last_n),
+                   {'min_increase_percentage': float(min_increase_percentage), 'last_n': last_n})
+    return pd.DataFrame(cursor.fetchall(), columns=['video_title', 'video_id', 'date', 'moving_average'])
+
+
+def check_parity(cursor, min_increase_percentage=MIN_INCREASE_PERCENTAGE, window=TREND_WINDOW):
+    """
+    Run the rule both in Postgres and on the full table in Python and compare the
+    trending video_ids. Returns a dict with the counts and the ids found by only one side.
+    """
+    cursor.execute(candidates_query(window), {'min_increase_percentage': float(min_increase_percentage)})
+    in_sql = {video_id for video_id, in cursor.fetchall()}
+
+    cursor.execute('SELECT video_title, video_id, date, moving_average FROM video_view_statistics')
+    df = pd.DataFrame(cursor.fetchall(), columns=['video_title', 'video_id', 'date', 'moving_average'])
+    _, result = detect_trends(df, min_increase_percentage, window)
+    in_python = set(result.loc[result['is_trending'], 'video_id'])
+
+    return {
+        'sql': len(in_sql),
+        'python': len(in_python),
+        'only_sql': sorted(in_sql - in_python),
+        'only_python': sorted(in_python - in_sql),
+        'match': in_sql == in_python,
+    }
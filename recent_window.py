@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Moving averages kept per video; the trend rule needs 6, the rest is for the charts
+RECENT_WINDOW_SIZE = int(os.environ.get('RECENT_WINDOW_SIZE', 30))
+# Days before the newest stored date that a refresh looks back at, to pick up statistics loaded late
+RECENT_WINDOW_LOOKBACK_DAYS = int(os.environ.get('RECENT_WINDOW_LOOKBACK_DAYS', 2))
+
+
+def ensure_recent_window_table(cursor):
+    # One row per video holding its latest moving averages, oldest first, and the
+    # title of its oldest row within them, like the other sources
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS video_recent_windows (
+        video_id TEXT PRIMARY KEY,
+        video_title TEXT,
+        dates DATE[] NOT NULL,
+        moving_averages DOUBLE PRECISION[] NOT NULL,
+        last_date DATE NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS video_recent_windows_last_date_idx ON video_recent_windows (last_date);
+    ''')
+
+
+def refresh_recent_windows(cursor, size=RECENT_WINDOW_SIZE, rebuild=False,
+                           lookback_days=RECENT_WINDOW_LOOKBACK_DAYS):
+    """
+    Bring video_recent_windows up to date with video_view_statistics.
+
+    Only videos with statistics dated within lookback_days of the newest stored
+    date, or later, are recomputed, so a daily refresh touches the daily delta and
+    can use an index on video_view_statistics (date). rebuild=True recomputes
+    every video, e.g. after back-filling older dates or changing size.
+    Returns the number of videos refreshed. The caller commits.
+    """
+    ensure_recent_window_table(cursor)
+    changed_filter = '' if rebuild else f'''
+        WHERE date > (SELECT coalesce(max(last_date), '-infinity'::date) FROM video_recent_windows)
+                     - {int(lookback_days)}
+    '''
+    cursor.execute(f'''
+    WITH changed AS (
+        SELECT DISTINCT video_id
+        FROM video_view_statistics
+        {changed_filter}
+    ), recent AS (
+        SELECT s.video_id, s.video_title, s.date, s.moving_average,
+               ROW_NUMBER() OVER (PARTITION BY s.video_id ORDER BY s.date DESC) AS row_number
+        FROM video_view_statistics s
+        JOIN changed USING (video_id)
+    )
+    INSERT INTO video_recent_windows (video_id, video_title, dates, moving_averages, last_date, updated_at)
+    SELECT video_id,
+           (array_agg(video_title ORDER BY date))[1],
+           array_agg(date::date ORDER BY date),
+           array_agg(moving_average::double precision ORDER BY date),
+           max(date)::date,
+           now()
+    FROM recent
+    WHERE row_number <= %s
+    GROUP BY video_id
+    ON CONFLICT (video_id) DO UPDATE
+    SET video_title = EXCLUDED.video_title,
+        dates = EXCLUDED.dates,
+        moving_averages = EXCLUDED.moving_averages,
+        last_date = EXCLUDED.last_date,
+        updated_at = EXCLUDED.updated_at;
+    ''', (size,))
+    return cursor.rowcount
+
+
+def fetch_recent_windows(cursor, last_n=None):
+    """
+    Read video_recent_windows into the same long format as fetch_moving_averages:
+    one row per video and day, with float moving averages. last_n keeps only the
+    newest last_n days of each video.
+    """
+    if last_n is None:
+        cursor.execute('''
+        SELECT video_id, video_title, dates, moving_averages
+        FROM video_recent_windows
+        ORDER BY video_id
+        ''')
+    else:
+        cursor.execute('''
+        SELECT video_id, video_title, dates[greatest(cardinality(dates) - %s + 1, 1):],
+               moving_averages[greatest(cardinality(moving_averages) - %s + 1, 1):]
+        FROM video_recent_windows
+        ORDER BY video_id
+        ''', (last_n, last_n))
+    rows = cursor.fetchall()
+    if not rows:
+        return pd.DataFrame(columns=['video_title', 'video_id', 'date', 'moving_average'])
+
+    video_ids, titles, dates, moving_averages = zip(*rows)
+    lengths = np.fromiter((len(window) for window in dates), dtype=np.int64, count=len(dates))
+    return pd.DataFrame({
+        'video_title': np.repeat(np.array(titles, dtype=object), lengths),
+        'video_id': np.repeat(np.array(video_ids, dtype=object), lengths),
+        'date': np.concatenate([np.array(window, dtype='datetime64[D]') for window in dates]),
+        'moving_average': np.concatenate([np.array(window, dtype=np.float64) for window in moving_averages]),
+    })
@@ -0,0 +1,122 @@
+import os
+import threading
+from io import BytesIO
+
+
+S3_TIMEOUT = float(os.environ.get('S3_TIMEOUT', 30))
+# Point at a local S3 stand-in such as moto_server or MinIO, e.g. http://localhost:9000
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+# Size of the client's connection pool, and of the parts uploaded at once for one object
+S3_MAX_CONCURRENCY = int(os.environ.get('S3_MAX_CONCURRENCY', 10))
+# Objects above this size are sent as multipart uploads of S3_MULTIPART_CHUNKSIZE parts
+S3_MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024))
+S3_MULTIPART_CHUNKSIZE = int(os.environ.get('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024))
+
+
+class S3Uploader:
+    """
+    A long-lived S3 client shared by the whole process.
+
+    boto3 clients are thread-safe, so credentials and the endpoint are resolved once
+    and every alert thread uploads its own chart over the same connection pool. Charts
+    are content-addressed, so a key that is known to exist (uploaded or seen by HEAD)
+    is never uploaded again.
+    """
+
+    def __init__(self, endpoint_url=S3_ENDPOINT_URL, max_concurrency=S3_MAX_CONCURRENCY):
+        # boto3 takes a while to import, so it is only loaded once something is uploaded
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.endpoint_url = endpoint_url
+        self.client = boto3.client(
+            's3',
+            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+            endpoint_url=endpoint_url,
+            config=Config(connect_timeout=S3_TIMEOUT, read_timeout=S3_TIMEOUT,
+                          max_pool_connections=max_concurrency,
+                          retries={'mode': 'standard', 'max_attempts': 3},
+                          # MinIO and moto serve buckets under the path, not as subdomains
+                          s3={'addressing_style': 'path' if endpoint_url else 'auto'}))
+        self.transfer_config = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                                              multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                                              max_concurrency=max_concurrency)
+        self._known_keys = set()
+        self._known_lock = threading.Lock()
+        # Cleared after the first 403 on HEAD, so credentials with only s3:PutObject stop checking
+        self._can_head = True
+
+    def public_url(self, bucket_name, key):
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{bucket_name}/{key}"
+        return f"https://{bucket_name}.s3.amazonaws.com/{key}"
+
+    def upload(self, bucket_name, key, data, content_type=None):
+        # Upload a file object or bytes and return the object's public URL.
+        # Returns None when no credentials are available.
+        from botocore.exceptions import NoCredentialsError
+        if isinstance(data, (bytes, bytearray)):
+            data = BytesIO(data)
+        extra_args = {'ContentType': content_type} if content_type else None
+        try:
+            self.client.upload_fileobj(data, bucket_name, key, ExtraArgs=extra_args, Config=self.transfer_config)
+        except NoCredentialsError:
+            print("Credentials not available")
+            return None
+        self._remember(bucket_name, key)
+        return self.public_url(bucket_name, key)
+
+    def exists(self, bucket_name, key):
+        # True or False, or None when we may not tell: without s3:ListBucket, S3 answers
+        # 403 instead of 404 for a missing key
+        from botocore.exceptions import ClientError, NoCredentialsError
+        try:
+            self.client.head_object(Bucket=bucket_name, Key=key)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            if code in ('403', 'AccessDenied', 'Forbidden'):
+                return None
+            raise
+        except NoCredentialsError:
+            print("Credentials not available")
+            return False
+        self._remember(bucket_name, key)
+        return True
+
+    def _remember(self, bucket_name, key):
+        with self._known_lock:
+            self._known_keys.add((bucket_name, key))
+
+    def upload_chart(self, bucket_name, key, png):
+        # Content-addressed upload: skip it when the object is already in the bucket
+        with self._known_lock:
+            known = (bucket_name, key) in self._known_keys
+        if known:
+            return self.public_url(bucket_name, key)
+        if self._can_head:
+            exists = self.exists(bucket_name, key)
+            if exists:
+                return self.public_url(bucket_name, key)
+            if exists is None:
+                # Existence is unknown; upload anyway, overwriting an identical object is harmless
+                self._can_head = False
+        return self.upload(bucket_name, key, png, content_type='image/png')
+
+
+_uploader = None
+_uploader_pid = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader():
+    # One uploader per process; a client inherited through fork must not be reused
+    global _uploader, _uploader_pid
+    with _uploader_lock:
+        if _uploader is None or _uploader_pid != os.getpid():
+            _uploader = S3Uploader()
+            _uploader_pid = os.getpid()
+        return _uploader
@@ -0,0 +1,34 @@
+import hashlib
+
+
+# Shard of a video: first 32 bits of md5(video_id) modulo the shard count.
+# md5 gives the same answer on every host and Postgres version, unlike hashtext().
+SHARD_SQL = "mod(('x' || substr(md5(video_id::text), 1, 8))::bit(32)::bigint, %s)"
+
+
+def shard_of(video_id, shards):
+    # Python version of SHARD_SQL
+    return int(hashlib.md5(str(video_id).encode('utf-8')).hexdigest()[:8], 16) % shards
+
+
+def parse_shard_spec(spec):
+    """
+    Parse a shard spec into (shard_ids, shards).
+
+    "3/16" is shard 3 of 16, "0-7/16" shards 0 to 7, "1,5,9/16" a list.
+    "16" on its own means all 16 shards. Several hosts can split one run by
+    each taking a disjoint part of the same N.
+    """
+    ids_part, _, shards_part = spec.rpartition('/')
+    shards = int(shards_part)
+    if shards < 1:
+        raise ValueError(f"Shard count must be at least 1: {spec}")
+    if not ids_part:
+        return list(range(shards)), shards
+    shard_ids = set()
+    for item in ids_part.split(','):
+        first, _, last = item.partition('-')
+        shard_ids.update(range(int(first), int(last or first) + 1))
+    if not all(0 <= shard_id < shards for shard_id in shard_ids):
+        raise ValueError(f"Shard ids must be between 0 and {shards - 1}: {spec}")
+    return sorted(shard_ids), shards
@@ -0,0 +1,191 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+
+SLACK_API_URL = 'https://slack.com/api/'
+SLACK_TIMEOUT = float(os.environ.get('SLACK_TIMEOUT', 15))
+# Attempts after the first one for a rate-limited, failed (5xx) or unreachable call
+SLACK_MAX_RETRIES = int(os.environ.get('SLACK_MAX_RETRIES', 5))
+# Keep-alive connections to slack.com, one per alert worker thread is enough
+SLACK_POOL_SIZE = int(os.environ.get('SLACK_POOL_SIZE', os.environ.get('ALERT_WORKERS', 8)))
+# chat.postMessage allows about one message per second per channel, with short bursts
+SLACK_POST_RATE = float(os.environ.get('SLACK_POST_RATE', 1))
+SLACK_POST_BURST = int(os.environ.get('SLACK_POST_BURST', 3))
+
+# (messages per second, burst) per API method; incoming webhooks allow one message per second.
+# Methods not listed are not throttled on our side.
+RATE_LIMITS = {
+    'chat.postMessage': (SLACK_POST_RATE, SLACK_POST_BURST),
+    'webhook': (1.0, 1),
+}
+
+# Slack truncates message text above 40,000 characters; batches stay well below that
+MAX_BATCH_TEXT = 3500
+
+
+class SlackError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average and up to `capacity` at once.
+
+    acquire() blocks until a call may go out. pause() stops all callers for a while,
+    e.g. for the Retry-After of a 429, so the threads sharing a method back off together.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Returns the seconds spent waiting
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    delay = (1 - self._tokens) / self.rate
+                else:
+                    delay = self._paused_until - now
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            # Refill from the end of the pause, not from before it
+            self._tokens = 0
+            self._updated = self._paused_until
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    # Exponential backoff with jitter: about 0.5s, 1s, 2s, ... up to cap
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class SlackClient:
+    """
+    Slack Web API and incoming webhook calls over one pooled keep-alive session.
+
+    Each method is throttled by its own token bucket (see RATE_LIMITS). A 429 pauses
+    that method's bucket for Retry-After seconds and the call is retried; 5xx responses
+    and connection errors are retried with exponential backoff. Read timeouts are not
+    retried, since Slack may already have posted the message.
+    Safe to share between the alert worker threads.
+    """
+
+    def __init__(self, token=None, webhook_url=None, timeout=SLACK_TIMEOUT, max_retries=SLACK_MAX_RETRIES,
+                 rate_limits=RATE_LIMITS, session=None):
+        self.token = token
+        self.webhook_url = webhook_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._buckets = {method: TokenBucket(rate, burst) for method, (rate, burst) in rate_limits.items()}
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SLACK_POOL_SIZE)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def _post(self, method, url, **kwargs):
+        bucket = self._buckets.get(method)
+        for attempt in range(self.max_retries + 1):
+            if bucket is not None:
+                waited = bucket.acquire()
+                if waited:
+                    metrics.observe('slack_throttle', waited)
+            delay = None
+            try:
+                response = self.session.post(url, timeout=self.timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                error, delay = e, backoff_delay(attempt)
+            else:
+                if response.status_code == 429:
+                    retry_after = float(response.headers.get('Retry-After', 1))
+                    error = SlackError(f"{method} was rate limited for {retry_after} seconds")
+                    metrics.increment('slack_rate_limited')
+                    if bucket is None:
+                        delay = retry_after
+                    else:
+                        bucket.pause(retry_after)
+                elif response.status_code >= 500:
+                    error = SlackError(f"{method} returned {response.status_code}: {response.text}")
+                    delay = backoff_delay(attempt)
+                else:
+                    return response
+            if attempt == self.max_retries:
+                break
+            metrics.increment('slack_retries')
+            if delay:
+                time.sleep(delay)
+        raise SlackError(f"{method} failed after {self.max_retries + 1} attempts: {error}")
+
+    def call(self, method, payload):
+        # Call a Web API method with a JSON body; returns the decoded response or raises SlackError
+        response = self._post(method, SLACK_API_URL + method, json=payload,
+                              headers={'Authorization': f'Bearer {self.token}'})
+        if response.status_code != 200:
+            raise SlackError(f"{method} returned {response.status_code}: {response.text}")
+        data = response.json()
+        if not data.get('ok'):
+            raise SlackError(f"{method} returned an error: {data.get('error')}")
+        return data
+
+    def post_message(self, message):
+        return self.call('chat.postMessage', message)
+
+    def post_webhook(self, message):
+        # Post a message to the incoming webhook, which answers with a plain "ok"
+        if not self.webhook_url:
+            raise SlackError("SLACK_WEBHOOK_URL is not set")
+        response = self._post('webhook', self.webhook_url, json=message)
+        if response.status_code != 200:
+            raise SlackError(f"Webhook returned {response.status_code}: {response.text}")
+
+    def post_webhook_lines(self, lines, header=None, max_text=MAX_BATCH_TEXT):
+        # Send many one-line notices as few webhook messages as possible, instead of one
+        # message (and one second of the webhook's rate limit) per line. Returns the messages sent.
+        batches, current = [], header or ''
+        for line in lines:
+            candidate = f"{current}\n{line}" if current else line
+            if len(candidate) > max_text and current and current != header:
+                batches.append(current)
+                candidate = f"{header}\n{line}" if header else line
+            current = candidate
+        if current and current != header:
+            batches.append(current)
+        for text in batches:
+            self.post_webhook({'text': text})
+        return len(batches)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_slack_client():
+    # One client per process, created on first use so .env has been loaded
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = SlackClient(token=os.environ.get('SLACK_BOT_TOKEN'),
+                                  webhook_url=os.environ.get('SLACK_WEBHOOK_URL'))
+        return _client
@@ -0,0 +1,254 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from db import get_cursor
+
+
+# Columnar snapshots of video_view_statistics kept between runs: one directory per full
+# download (named by its watermark), with the rows fetched by later runs appended under segments/
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'trend_snapshots'))
+SNAPSHOT_MAX_BYTES = int(os.environ.get('SNAPSHOT_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+# Days before the snapshot watermark that are fetched again, to pick up statistics loaded late
+SNAPSHOT_LOOKBACK_DAYS = int(os.environ.get('SNAPSHOT_LOOKBACK_DAYS', 2))
+# Segments appended to a snapshot before it is rewritten as one new snapshot
+SNAPSHOT_MAX_SEGMENTS = int(os.environ.get('SNAPSHOT_MAX_SEGMENTS', 14))
+# Bumped when the on-disk layout changes; snapshots in another format are downloaded again
+SNAPSHOT_FORMAT = 2
+
+ARRAYS = ('video_id_codes', 'video_ids', 'video_title_codes', 'video_titles', 'date', 'moving_average')
+
+
+def _snapshot_dirs():
+    # Snapshot directories, oldest watermark first
+    try:
+        names = [name for name in os.listdir(SNAPSHOT_DIR)
+                 if os.path.isfile(os.path.join(SNAPSHOT_DIR, name, 'meta.json'))]
+    except FileNotFoundError:
+        return []
+    return [os.path.join(SNAPSHOT_DIR, name) for name in sorted(names)]
+
+
+def _segment_dirs(path):
+    # Segments appended to the snapshot at path, oldest first
+    segments_path = os.path.join(path, 'segments')
+    try:
+        names = [name for name in os.listdir(segments_path)
+                 if os.path.isfile(os.path.join(segments_path, name, 'meta.json'))]
+    except FileNotFoundError:
+        return []
+    return [os.path.join(segments_path, name) for name in sorted(names)]
+
+
+def _dir_size(path):
+    return sum(_dir_size(entry.path) if entry.is_dir() else entry.stat().st_size for entry in os.scandir(path))
+
+
+def rows_to_frame(rows):
+    # psycopg2 rows (video_title, video_id, date, moving_average) to the compact snapshot layout
+    if not rows:
+        return pd.DataFrame({
+            'video_title': pd.Categorical([]),
+            'video_id': pd.Categorical([]),
+            'date': np.array([], dtype='datetime64[s]'),
+            'moving_average': np.array([], dtype=np.float64),
+        })
+    titles, video_ids, dates, moving_averages = zip(*rows)
+    return pd.DataFrame({
+        'video_title': pd.Categorical(titles),
+        'video_id': pd.Categorical(video_ids),
+        'date': np.array(dates, dtype='datetime64[D]').astype('datetime64[s]'),
+        'moving_average': np.array(moving_averages, dtype=np.float64),
+    })
+
+
+def load_part(path):
+    """
+    Open a snapshot or segment directory as a DataFrame backed by memory-mapped arrays.
+
+    The numeric columns and the category codes are read straight from the page
+    cache; only the (much smaller) lists of distinct ids and titles are copied.
+    Rows are stored in date order. Returns (df, meta).
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ARRAYS}
+    df = pd.DataFrame({
+        'video_title': pd.Categorical.from_codes(arrays['video_title_codes'], categories=arrays['video_titles'].astype(object)),
+        'video_id': pd.Categorical.from_codes(arrays['video_id_codes'], categories=arrays['video_ids'].astype(object)),
+        'date': arrays['date'],
+        'moving_average': arrays['moving_average'],
+    }, copy=False)
+    return df, meta
+
+
+def write_part(df, path, **meta):
+    # Write df sorted by date to the directory path, replacing it atomically
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+    # Stored as datetime64[s] and with pandas' own code widths, so loading needs no conversion
+    order = np.argsort(df['date'].to_numpy(dtype='datetime64[s]'), kind='stable')
+    video_ids = df['video_id'].astype('category').array
+    video_titles = df['video_title'].astype('category').array
+    arrays = {
+        'video_id_codes': video_ids.codes[order],
+        'video_ids': video_ids.categories.to_numpy(dtype=str),
+        'video_title_codes': video_titles.codes[order],
+        'video_titles': video_titles.categories.to_numpy(dtype=str),
+        'date': df['date'].to_numpy(dtype='datetime64[s]')[order],
+        'moving_average': df['moving_average'].to_numpy(dtype=np.float64)[order],
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'format': SNAPSHOT_FORMAT, 'rows': len(df), 'created_at': datetime.datetime.now().isoformat(),
+                   **meta}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    return path
+
+
+def save_snapshot(df, watermark):
+    # Write df as a new snapshot under SNAPSHOT_DIR/<watermark>, then evict old snapshots over the size limit
+    path = write_part(df, os.path.join(SNAPSHOT_DIR, watermark.isoformat()), watermark=watermark.isoformat())
+    evict_snapshots()
+    return path
+
+
+def append_segment(path, df, since, watermark):
+    # Append df, the statistics with since < date <= watermark, to the snapshot at path
+    segments = _segment_dirs(path)
+    number = int(os.path.basename(segments[-1])) + 1 if segments else 1
+    return write_part(df, os.path.join(path, 'segments', f'{number:04d}'),
+                      since=since.isoformat(), watermark=watermark.isoformat())
+
+
+def evict_snapshots(max_bytes=None):
+    # Delete the oldest snapshots until the directory fits in max_bytes, always keeping the newest
+    max_bytes = SNAPSHOT_MAX_BYTES if max_bytes is None else max_bytes
+    paths = _snapshot_dirs()
+    sizes = {path: _dir_size(path) for path in paths}
+    total = sum(sizes.values())
+    for path in paths[:-1]:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= sizes[path]
+
+
+def load_snapshot(path):
+    """
+    Open the snapshot at path with its segments. Returns (parts, watermark).
+
+    parts are memory-mapped DataFrames, the snapshot first. Each segment replaces
+    the rows of earlier parts dated after its `since`, so every part is cut to the
+    rows no later segment replaces. Parts are sorted by date, so the cuts are prefix
+    slices and stay memory-mapped.
+    """
+    loaded = [load_part(path)] + [load_part(segment) for segment in _segment_dirs(path)]
+    parts = []
+    for i, (df, meta) in enumerate(loaded):
+        cutoffs = [later['since'] for _, later in loaded[i + 1:]]
+        if cutoffs:
+            stop = np.searchsorted(df['date'].to_numpy(), np.datetime64(min(cutoffs), 's'), side='right')
+            df = df.iloc[:stop]
+        parts.append(df)
+    return parts, datetime.date.fromisoformat(loaded[-1][1]['watermark'])
+
+
+def concat_parts(parts):
+    # One DataFrame from the snapshot parts; a lone part is returned as is, still memory-mapped
+    parts = [df for df in parts if len(df)] or parts[:1]
+    if len(parts) == 1:
+        return parts[0]
+    return pd.DataFrame({
+        'video_title': pd.api.types.union_categoricals([df['video_title'].array for df in parts]),
+        'video_id': pd.api.types.union_categoricals([df['video_id'].array for df in parts]),
+        'date': np.concatenate([df['date'].to_numpy() for df in parts]),
+        'moving_average': np.concatenate([df['moving_average'].to_numpy() for df in parts]),
+    })
+
+
+def rows_after(parts, since):
+    # Rows dated after since across the (date sorted) parts
+    cutoff = np.datetime64(since, 's')
+    return sum(len(df) - int(np.searchsorted(df['date'].to_numpy(), cutoff, side='right')) for df in parts)
+
+
+def parts_before(parts, since):
+    # The parts cut to the rows dated on or before since
+    cutoff = np.datetime64(since, 's')
+    return [df.iloc[:np.searchsorted(df['date'].to_numpy(), cutoff, side='right')] for df in parts]
+
+def fetch_statistics_since(since, upto):
+    # Statistics rows with since < date <= upto; since=None fetches everything up to upto
+    with get_cursor() as cursor:
+        if since is None:
+            cursor.execute('''
+            SELECT video_title, video_id, date, moving_average
+            FROM video_view_statistics
+            WHERE date <= %s
+            ''', (upto,))
+        else:
+            cursor.execute('''
+            SELECT video_title, video_id, date, moving_average
+            FROM video_view_statistics
+            WHERE date > %s AND date <= %s
+            ''', (since, upto))
+        return cursor.fetchall()
+
+
+def fetch_snapshot_frame(refresh=False, lookback_days=SNAPSHOT_LOOKBACK_DAYS):
+    """
+    Return all of video_view_statistics as a compact DataFrame, using the newest
+    local snapshot plus only the rows dated after its watermark (less lookback_days).
+
+    When the database has no rows after the watermark and the same number of rows
+    in the look-back window, the memory-mapped frame is returned as it is. Otherwise
+    the re-fetched rows are appended to the snapshot as a segment; after
+    SNAPSHOT_MAX_SEGMENTS segments everything is rewritten as a new snapshot.
+    refresh=True ignores existing snapshots and downloads everything again.
+    Assumes statistics older than the look-back window are not rewritten.
+    """
+    paths = [] if refresh else _snapshot_dirs()
+    parts = None
+    if paths:
+        with open(os.path.join(paths[-1], 'meta.json')) as f:
+            if json.load(f).get('format') == SNAPSHOT_FORMAT:
+                parts, watermark = load_snapshot(paths[-1])
+
+    since = watermark - datetime.timedelta(days=lookback_days) if parts else None
+    with get_cursor() as cursor:
+        cursor.execute('SELECT max(date), count(*) FILTER (WHERE date > %s) FROM video_view_statistics',
+                       (since or datetime.date.min,))
+        upto, recent_rows = cursor.fetchone()
+    if upto is None:
+        return rows_to_frame([])
+    if isinstance(upto, datetime.datetime):
+        upto = upto.date()
+
+    if parts is None:
+        print("Downloading a full statistics snapshot...")
+        df = rows_to_frame(fetch_statistics_since(None, upto))
+        save_snapshot(df, upto)
+        return df
+
+    if upto <= watermark and recent_rows == rows_after(parts, since):
+        return concat_parts(parts)
+
+    # Re-fetch the look-back window and everything after it; the segment replaces the snapshot's tail
+    print(f"Appending statistics after {since} to snapshot {watermark}...")
+    newer = rows_to_frame(fetch_statistics_since(since, upto))
+    df = concat_parts(parts_before(parts, since) + [newer])
+    if len(_segment_dirs(paths[-1])) >= SNAPSHOT_MAX_SEGMENTS:
+        save_snapshot(df, upto)
+    else:
+        append_segment(paths[-1], newer, since, upto)
+    return df
+
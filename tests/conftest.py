@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+# Keep the process-wide metrics from publishing to whatever Postgres the environment points at
+os.environ.setdefault('METRICS_STORE', 'none')
+
+
+@pytest.fixture(scope='session')
+def postgres(tmp_path_factory):
+    # A throwaway Postgres started by pgserver for the whole test session; skipped without it
+    pgserver = pytest.importorskip('pgserver')
+    try:
+        server = pgserver.get_server(tmp_path_factory.mktemp('pgdata'))
+    except Exception as e:
+        pytest.skip(f"Could not start a throwaway Postgres: {e}")
+    yield server
+    server.cleanup()
+
+
+@pytest.fixture
+def pipeline_database(postgres, monkeypatch):
+    """
+    Point the db pool at a fresh database on the throwaway server, with the pipeline's tables.
+
+    Yields a cursor on it that commits each statement.
+    """
+    import psycopg2
+    import db
+    admin = psycopg2.connect(postgres.get_uri())
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute('DROP DATABASE IF EXISTS pipeline_test')
+        cursor.execute('CREATE DATABASE pipeline_test')
+    db.close_pool()
+    monkeypatch.setitem(db.db_params, 'database', 'pipeline_test')
+    monkeypatch.setitem(db.db_params, 'user', postgres.postgres_user)
+    monkeypatch.setitem(db.db_params, 'password', '')
+    monkeypatch.setitem(db.db_params, 'host', str(postgres.pgdata))
+    monkeypatch.setitem(db.db_params, 'port', None)
+    conn = psycopg2.connect(**db.db_params)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute('''
+    CREATE TABLE video_view_statistics (video_title TEXT, video_id TEXT, date DATE, moving_average NUMERIC);
+    CREATE TABLE videos (video_id TEXT PRIMARY KEY, video_url TEXT);
+    CREATE TABLE current_trending_videos (
+        video_id TEXT PRIMARY KEY, last_moving_average NUMERIC, trend_status TEXT,
+        last_alert_date DATE, times_trended INT DEFAULT 0
+    );
+    ''')
+    yield cursor
+    conn.close()
+    db.close_pool()
+    with admin.cursor() as cursor:
+        cursor.execute('DROP DATABASE IF EXISTS pipeline_test WITH (FORCE)')
+    admin.close()
@@ -0,0 +1,36 @@
+import threading
+
+from alert_queue import AlertDispatcher
+
+
+def test_close_waits_for_running_alerts_after_timeout():
+    started, release = threading.Event(), threading.Event()
+
+    def deliver(name):
+        started.set()
+        release.wait(5)
+        return True
+
+    dispatcher = AlertDispatcher(deliver, max_workers=1, timeout=0.1)
+    for name in ('a', 'b', 'c'):
+        dispatcher.submit(name)
+    assert started.wait(5)
+    # 'a' is posting when the timeout hits; it finishes afterwards and must count as sent
+    threading.Timer(0.3, release.set).start()
+    results = dispatcher.close()
+    assert results['sent'] == [('a',)]
+    assert results['timed_out'] == [('b',), ('c',)]
+    assert results['failed'] == []
+
+
+def test_close_sorts_sent_and_failed():
+    def deliver(name):
+        if name == 'boom':
+            raise RuntimeError('Slack is down')
+        return name == 'ok'
+
+    with AlertDispatcher(deliver, max_workers=2) as dispatcher:
+        for name in ('ok', 'no', 'boom'):
+            dispatcher.submit(name)
+        results = dispatcher.close()
+    assert results == {'sent': [('ok',)], 'failed': [('no',), ('boom',)], 'timed_out': []}
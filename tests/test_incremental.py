@@ -0,0 +1,79 @@
+import datetime
+
+import pytest
+
+import main
+
+
+def insert_days(cursor, video_id, start, values):
+    for day, value in enumerate(values):
+        cursor.execute('INSERT INTO video_view_statistics VALUES (%s, %s, %s, %s)',
+                       (f'Title {video_id}', video_id, start + datetime.timedelta(days=day), value))
+
+
+@pytest.fixture
+def sent_alerts(pipeline_database, monkeypatch):
+    # Record alerts instead of rendering and posting them; setting outcome[0] = False makes them fail
+    sent, outcome = [], [True]
+
+    def send_slack_alert(video_id, group, trend_status, video_url=None):
+        if outcome[0]:
+            sent.append((video_id, trend_status))
+        return outcome[0]
+
+    monkeypatch.setattr(main, 'send_slack_alert', send_slack_alert)
+    return sent, outcome
+
+
+def test_two_incremental_runs_in_a_row(pipeline_database, sent_alerts):
+    cursor = pipeline_database
+    sent, _ = sent_alerts
+    insert_days(cursor, 'a', datetime.date(2024, 1, 1), [10, 11, 12, 13, 14, 20])
+    main.run_pipeline(mode='incremental')
+    assert sent == [('a', 'new')]
+
+    # The watermark reads back from its TIMESTAMP column; the second run must still compare it
+    insert_days(cursor, 'b', datetime.date(2024, 1, 2), [10, 11, 12, 13, 14, 20])
+    main.run_pipeline(mode='incremental')
+    assert sent == [('a', 'new'), ('b', 'new')]
+    cursor.execute('SELECT watermark::date FROM trend_run_watermarks')
+    assert cursor.fetchone()[0] == datetime.date(2024, 1, 7)
+
+
+def test_rows_loaded_late_for_the_watermark_date_are_picked_up(pipeline_database, sent_alerts):
+    cursor = pipeline_database
+    sent, _ = sent_alerts
+    insert_days(cursor, 'a', datetime.date(2024, 1, 1), [10, 10, 10, 10, 10, 10])
+    main.run_pipeline(mode='incremental')
+    # 'b' arrives after the run, for dates up to the watermark the run already recorded
+    insert_days(cursor, 'b', datetime.date(2024, 1, 1), [10, 11, 12, 13, 14, 20])
+    main.run_pipeline(mode='incremental')
+    assert sent == [('b', 'new')]
+
+
+def test_failed_alerts_keep_the_watermark_and_go_out_again(pipeline_database, sent_alerts):
+    cursor = pipeline_database
+    sent, outcome = sent_alerts
+    insert_days(cursor, 'a', datetime.date(2024, 1, 1), [10, 11, 12, 13, 14, 20])
+    main.run_pipeline(mode='incremental')
+    insert_days(cursor, 'b', datetime.date(2024, 1, 10), [10, 11, 12, 13, 14, 20])
+    outcome[0] = False
+    main.run_pipeline(mode='incremental')
+    cursor.execute('SELECT watermark::date FROM trend_run_watermarks')
+    assert cursor.fetchone()[0] == datetime.date(2024, 1, 6)
+
+    # Later days push 'b' out of the look-back window, but the held watermark still covers it
+    insert_days(cursor, 'c', datetime.date(2024, 1, 20), [1])
+    outcome[0] = True
+    main.run_pipeline(mode='incremental')
+    assert sent == [('a', 'new'), ('b', 'new')]
+
+
+def test_incremental_runs_fetch_the_widest_detector_window(pipeline_database, sent_alerts, monkeypatch):
+    cursor = pipeline_database
+    monkeypatch.setattr(main, 'TREND_DETECTORS', ['zscore_spike'])
+    monkeypatch.setattr(main, 'FETCH_WINDOW', 14)
+    insert_days(cursor, 'spike', datetime.date(2024, 1, 1), [10, 11, 10, 11, 10, 11, 10, 11, 10, 11, 10, 11, 10, 50])
+    progress = main.new_progress()
+    main.run_pipeline(mode='incremental', progress=progress)
+    assert progress['detector_hits'] == {'zscore_spike': 1}
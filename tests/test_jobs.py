@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+
+import main
+from db import advisory_lock
+from jobs import JobRunner, PostgresJobStore
+
+
+def test_runs_merge_while_another_process_holds_the_pipeline_lock(pipeline_database, monkeypatch):
+    monkeypatch.setattr(main, 'run_analysis', lambda *args: pytest.fail("the run should have been merged"))
+    with advisory_lock(*main.pipeline_locks('full')) as acquired:
+        assert acquired
+        progress = main.new_progress()
+        assert main.run_pipeline(progress=progress) is None
+        assert progress['merged']
+
+
+def test_hosts_can_split_a_sharded_run_but_not_repeat_a_shard(pipeline_database):
+    with advisory_lock(*main.pipeline_locks('sharded', '0-3/8')) as first:
+        with advisory_lock(*main.pipeline_locks('sharded', '4-7/8')) as second:
+            assert first and second
+        with advisory_lock(*main.pipeline_locks('sharded', '3/8')) as repeated:
+            assert not repeated
+        with advisory_lock(*main.pipeline_locks('full')) as full:
+            assert not full
+    with advisory_lock(*main.pipeline_locks('full')) as full:
+        assert full
+
+
+def wait_for(runner, job_id, check):
+    # Poll the job as another worker would, until check(job) holds or about 5 seconds pass
+    job = None
+    for _ in range(100):
+        job = runner.get(job_id)
+        if job and check(job):
+            break
+        time.sleep(0.05)
+    return job
+
+
+def test_jobs_are_visible_from_other_workers(pipeline_database):
+    first, second = (JobRunner(store=PostgresJobStore(), progress_interval=0.05) for _ in range(2))
+    release = threading.Event()
+
+    def slow_run(progress):
+        progress['videos_scanned'] = 7
+        release.wait(10)
+
+    job, _ = first.trigger('full', slow_run, {})
+    try:
+        seen = wait_for(second, job['id'], lambda job: job['progress'].get('videos_scanned') == 7)
+        assert seen['status'] == 'running' and seen['progress']['videos_scanned'] == 7
+
+        # The other worker's run found the pipeline lock taken and merged into the running job
+        merged, _ = second.trigger('full', lambda progress: progress.update(merged=True), {})
+        merged = wait_for(second, merged['id'], lambda job: job['status'] not in ('queued', 'running'))
+        assert merged['status'] == 'merged' and merged['merged_into'] == job['id']
+    finally:
+        release.set()
+    assert wait_for(second, job['id'], lambda job: job['status'] == 'finished')['status'] == 'finished'
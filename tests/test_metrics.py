@@ -0,0 +1,47 @@
+import metrics as metrics_module
+from metrics import Metrics, PostgresMetricsStore
+
+
+def test_shared_snapshot_adds_up_published_processes(pipeline_database):
+    cli_run = Metrics(store=PostgresMetricsStore())
+    cli_run.increment('alerts_sent', 2)
+    cli_run.observe('fetch', 0.2)
+    cli_run.flush()
+    worker = Metrics(store=PostgresMetricsStore())
+    worker.increment('alerts_sent')
+    worker.observe('fetch', 0.4)
+    worker.flush()
+
+    app = Metrics(store=PostgresMetricsStore())
+    app.increment('alerts_sent', 4)
+    shared = app.shared_snapshot()
+    assert shared['processes'] == 3
+    assert shared['counters']['alerts_sent'] == 7
+    assert shared['timings']['fetch']['count'] == 2
+    assert abs(shared['timings']['fetch']['mean'] - 0.3) < 1e-9
+
+    # A process re-publishing replaces its own row rather than adding to it
+    cli_run.increment('alerts_sent')
+    cli_run.flush()
+    assert app.shared_snapshot()['counters']['alerts_sent'] == 8
+    for instance in (cli_run, worker, app):
+        # Their atexit flush would otherwise publish to the database once it is gone
+        instance.configure([])
+
+
+def test_drain_hands_over_each_count_once():
+    # A shard worker process may analyze several shards; the parent merges every return
+    worker, parent = Metrics(), Metrics()
+    for _ in range(2):
+        worker.increment('shard_rows', 5)
+        parent.merge(worker.drain())
+    assert parent.snapshot()['counters']['shard_rows'] == 10
+
+
+def test_shared_snapshot_without_store():
+    local = Metrics()
+    local.increment('alerts_sent')
+    shared = local.shared_snapshot()
+    assert shared['processes'] == 1
+    assert shared['counters'] == {'alerts_sent': 1}
+    assert metrics_module.store_from_env() is None
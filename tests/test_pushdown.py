@@ -0,0 +1,111 @@
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pushdown import candidates_query, fetch_pushdown_candidates
+from trends import detect_trends
+
+
+EDGE_CASES = {
+    'rising': [10, 11, 12, 13, 14, 20],
+    'exactly_15_percent': [100, 101, 102, 103, 104, 115],
+    'just_below_15_percent': [100, 101, 102, 103, 104, 114.99],
+    'exactly_15_percent_inexact_float': [1, 1.001, 1.002, 1.003, 1.004, 1.15],
+    'zero_start': [0, 1, 2, 3, 4, 5],
+    'zero_start_flat_end': [0, 1, 2, 3, 4, 4],
+    'negative_start': [-10, -9, -8, -7, -6, -5],
+    'nan_last': [1, 2, 3, 4, 5, 'NaN'],
+    'nan_inside': [1, 2, 'NaN', 4, 5, 6],
+    'null_last': [1, 2, 3, 4, 5, None],
+    'too_short': [1, 2, 3, 4, 5],
+    'older_dip': [50, 10, 11, 12, 13, 14, 20],
+    'falling': [20, 19, 18, 17, 16, 15],
+}
+
+
+def test_candidates_query_shape():
+    query = candidates_query(6)
+    for lag in range(1, 6):
+        assert f'LAG(moving_average, {lag}) OVER w AS m{lag}' in query
+        assert f'm{lag} < m{lag - 1}' in query
+    assert 'LAG(moving_average, 6)' not in query
+    assert 'LEAD(date) OVER w AS next_date' in query
+    assert 'WHEN m5 = 0 THEN true' in query
+    assert "m0 <> 'NaN'" in query
+    assert '::numeric' in query and 'double precision' not in query
+    with pytest.raises(ValueError):
+        candidates_query(1)
+
+
+@pytest.fixture(scope='module')
+def connection(request):
+    # The database in TEST_DATABASE_DSN, or the throwaway Postgres from conftest; skipped without either
+    psycopg2 = pytest.importorskip('psycopg2')
+    dsn = os.environ.get('TEST_DATABASE_DSN') or request.getfixturevalue('postgres').get_uri()
+    conn = psycopg2.connect(dsn)
+    yield conn
+    conn.close()
+
+
+def load_statistics(conn, series):
+    # A temporary video_view_statistics shadows any real table for this session only
+    cursor = conn.cursor()
+    cursor.execute('''
+    CREATE TEMP TABLE IF NOT EXISTS video_view_statistics (
+        video_title TEXT, video_id TEXT, date DATE, moving_average NUMERIC
+    );
+    TRUNCATE video_view_statistics;
+    ''')
+    rows = [(name, name, datetime.date(2024, 1, 1) + datetime.timedelta(days=day), value)
+            for name, values in series.items() for day, value in enumerate(values)]
+    cursor.executemany('INSERT INTO video_view_statistics VALUES (%s, %s, %s, %s)', rows)
+    return cursor
+
+
+def python_trending(cursor, window=6, min_increase_percentage=15):
+    cursor.execute('SELECT video_title, video_id, date, moving_average FROM video_view_statistics')
+    df = pd.DataFrame(cursor.fetchall(), columns=['video_title', 'video_id', 'date', 'moving_average'])
+    _, result = detect_trends(df, min_increase_percentage, window)
+    return set(result.loc[result['is_trending'], 'video_id'])
+
+
+def sql_trending(cursor, window=6, min_increase_percentage=15):
+    cursor.execute(candidates_query(window), {'min_increase_percentage': float(min_increase_percentage)})
+    return {video_id for video_id, in cursor.fetchall()}
+
+
+def test_edge_cases_match_python(connection):
+    cursor = load_statistics(connection, EDGE_CASES)
+    assert sql_trending(cursor) == python_trending(cursor)
+    assert sql_trending(cursor) == {'rising', 'exactly_15_percent', 'exactly_15_percent_inexact_float', 'zero_start', 'older_dip'}
+    connection.rollback()
+
+
+@pytest.mark.parametrize('window, min_increase_percentage', [(6, 15), (4, 5), (3, 30)])
+def test_random_videos_match_python(connection, window, min_increase_percentage):
+    rng = np.random.default_rng(window)
+    series = {}
+    for video in range(400):
+        base = rng.uniform(0, 50)
+        if video % 3 == 0:
+            values = base * 1.06 ** np.arange(rng.integers(0, 12))
+        else:
+            values = base + rng.normal(0, 5, size=rng.integers(0, 12))
+        series[f'vid{video:04d}'] = np.round(values, 4).tolist()
+    cursor = load_statistics(connection, series)
+    assert sql_trending(cursor, window, min_increase_percentage) == \
+        python_trending(cursor, window, min_increase_percentage)
+    connection.rollback()
+
+
+def test_fetches_only_candidate_rows(connection):
+    cursor = load_statistics(connection, EDGE_CASES)
+    df = fetch_pushdown_candidates(cursor, last_n=3)
+    assert set(df['video_id']) == {'rising', 'exactly_15_percent', 'exactly_15_percent_inexact_float', 'zero_start', 'older_dip'}
+    assert (df.groupby('video_id').size() == 3).all()
+    df = fetch_pushdown_candidates(cursor)
+    assert (df['video_id'] == 'older_dip').sum() == len(EDGE_CASES['older_dip'])
+    connection.rollback()
@@ -0,0 +1,51 @@
+import datetime
+
+import main
+from recent_window import fetch_recent_windows, refresh_recent_windows
+
+
+def insert_day(cursor, video_id, title, date, value):
+    cursor.execute('INSERT INTO video_view_statistics VALUES (%s, %s, %s, %s)', (title, video_id, date, value))
+
+
+def window(cursor, video_id):
+    cursor.execute('SELECT video_title, dates, moving_averages FROM video_recent_windows WHERE video_id = %s',
+                   (video_id,))
+    return cursor.fetchone()
+
+
+def test_backfill_needs_rebuild_and_titles_come_from_the_oldest_row(pipeline_database):
+    cursor = pipeline_database
+    start = datetime.date(2024, 3, 1)
+    for day in range(10):
+        insert_day(cursor, 'a', 'Old title' if day == 0 else 'New title', start + datetime.timedelta(days=day), day)
+    refresh_recent_windows(cursor)
+    assert window(cursor, 'a')[0] == 'Old title'
+    assert window(cursor, 'a')[1][0] == start
+
+    # A date back-filled for a video with nothing recent is not picked up by a plain refresh
+    for day in range(3):
+        insert_day(cursor, 'b', 'B', start + datetime.timedelta(days=day), day)
+    refresh_recent_windows(cursor, rebuild=True)
+    backfilled = start - datetime.timedelta(days=1)
+    insert_day(cursor, 'b', 'Back-filled title', backfilled, -1)
+    refresh_recent_windows(cursor)
+    assert window(cursor, 'b')[1][0] == start
+    refresh_recent_windows(cursor, rebuild=True)
+    title, dates, moving_averages = window(cursor, 'b')
+    assert (title, dates[0], moving_averages[0]) == ('Back-filled title', backfilled, -1)
+
+    # So does a smaller RECENT_WINDOW_SIZE
+    refresh_recent_windows(cursor, size=4, rebuild=True)
+    title, dates, _ = window(cursor, 'a')
+    assert len(dates) == 4 and title == 'New title'
+    assert len(fetch_recent_windows(cursor)) == 4 + 4
+
+
+def test_rebuild_window_reaches_the_refresh(pipeline_database, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, 'refresh_recent_windows', lambda cursor, rebuild: calls.append(rebuild) or 0)
+    monkeypatch.setattr(main, 'fetch_recent_windows', lambda cursor, last_n: None)
+    main.run_analysis(source='window', rebuild_window=True)
+    main.run_analysis(source='window')
+    assert calls == [True, False]
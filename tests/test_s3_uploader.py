@@ -0,0 +1,71 @@
+import os
+import uuid
+
+import pytest
+
+from s3_uploader import S3_ENDPOINT_URL, S3Uploader
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    """
+    Yields an S3Uploader factory and an empty bucket: on the S3_ENDPOINT_URL stand-in
+    (MinIO, moto_server) when set, otherwise on moto in process, skipped without it.
+    """
+    for name, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        if name not in os.environ:
+            monkeypatch.setenv(name, value)
+    bucket_name = f"charts-test-{uuid.uuid4().hex[:12]}"
+    if S3_ENDPOINT_URL:
+        S3Uploader().client.create_bucket(Bucket=bucket_name)
+        yield S3Uploader, bucket_name
+        return
+    moto = pytest.importorskip('moto')
+    with moto.mock_aws():
+        S3Uploader().client.create_bucket(Bucket=bucket_name)
+        yield S3Uploader, bucket_name
+
+
+def count_uploads(uploader, monkeypatch):
+    uploads = []
+    upload_fileobj = uploader.client.upload_fileobj
+    monkeypatch.setattr(uploader.client, 'upload_fileobj',
+                        lambda *args, **kwargs: uploads.append(args[2]) or upload_fileobj(*args, **kwargs))
+    return uploads
+
+
+def test_upload_chart_skips_keys_already_in_the_bucket(s3_bucket, monkeypatch):
+    make_uploader, bucket_name = s3_bucket
+    uploader = make_uploader()
+    uploads = count_uploads(uploader, monkeypatch)
+
+    url = uploader.upload_chart(bucket_name, 'charts/abc.png', b'\x89PNG chart')
+    assert url == uploader.public_url(bucket_name, 'charts/abc.png')
+    stored = uploader.client.get_object(Bucket=bucket_name, Key='charts/abc.png')
+    assert stored['Body'].read() == b'\x89PNG chart'
+    assert stored['ContentType'] == 'image/png'
+    assert uploader.upload_chart(bucket_name, 'charts/abc.png', b'\x89PNG chart') == url
+    assert uploads == ['charts/abc.png']
+
+    # Another process only knows the key from HEAD
+    other = make_uploader()
+    other_uploads = count_uploads(other, monkeypatch)
+    assert other.exists(bucket_name, 'charts/abc.png') is True
+    assert other.exists(bucket_name, 'charts/missing.png') is False
+    assert other.upload_chart(bucket_name, 'charts/abc.png', b'\x89PNG chart') == url
+    assert other_uploads == []
+
+
+def test_large_objects_go_up_in_parts(s3_bucket):
+    from boto3.s3.transfer import TransferConfig
+    make_uploader, bucket_name = s3_bucket
+    uploader = make_uploader()
+    mb = 1024 * 1024
+    uploader.transfer_config = TransferConfig(multipart_threshold=5 * mb, multipart_chunksize=5 * mb)
+    data = os.urandom(11 * mb)
+    uploader.upload(bucket_name, 'big.bin', data)
+    stored = uploader.client.head_object(Bucket=bucket_name, Key='big.bin')
+    # A multipart ETag ends with the number of parts
+    assert stored['ETag'].strip('"').endswith('-3')
+    assert uploader.client.get_object(Bucket=bucket_name, Key='big.bin')['Body'].read() == data
@@ -0,0 +1,173 @@
+import datetime
+from decimal import Decimal, DivisionByZero, InvalidOperation, localcontext
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from main import is_trending
+from trends import detect_trends, detectors_window, parse_detectors
+
+
+def random_statistics(videos, seed):
+    # Synthetic video_view_statistics rows in random order: rising, noisy, tiny integer and
+    # negative series, histories shorter and longer than the window, and some NaN values
+    rng = np.random.default_rng(seed)
+    rows = []
+    for video in range(videos):
+        length = int(rng.integers(0, 12))
+        base = rng.uniform(1, 100)
+        kind = rng.integers(0, 4)
+        for day in range(length):
+            if kind == 0:
+                value = base * 1.04 ** day
+            elif kind == 1:
+                value = base + rng.normal(0, 5)
+            elif kind == 2:
+                value = float(rng.integers(0, 4))
+            else:
+                value = -base + day
+            if rng.random() < 0.02:
+                value = np.nan
+            rows.append((f'Title {video}', f'vid{video:05d}', datetime.date(2024, 1, 1) + datetime.timedelta(days=day),
+                         value))
+    df = pd.DataFrame(rows, columns=['video_title', 'video_id', 'date', 'moving_average'])
+    return df.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def statistics_for(series):
+    # One video per named series, days in order
+    rows = [(name, name, datetime.date(2024, 1, 1) + datetime.timedelta(days=day), value)
+            for name, values in series.items() for day, value in enumerate(values)]
+    return pd.DataFrame(rows, columns=['video_title', 'video_id', 'date', 'moving_average'])
+
+
+def expected(df):
+    # The original per-group rule, on each video's rows sorted by date. Division by zero
+    # gives inf (or NaN for 0/0) like numpy, for floats and Decimals alike
+    with np.errstate(divide='ignore', invalid='ignore'), localcontext() as context:
+        context.traps[DivisionByZero] = context.traps[InvalidOperation] = False
+        return {video_id: bool(is_trending(group.sort_values(by='date')))
+                for video_id, group in df.groupby('video_id')}
+
+
+def detected(df):
+    _, result = detect_trends(df)
+    return dict(zip(result['video_id'], result['is_trending'].tolist()))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_is_trending_on_random_videos(seed):
+    df = random_statistics(600, seed)
+    assert detected(df) == expected(df)
+
+
+def test_matches_is_trending_on_edge_cases():
+    df = statistics_for({
+        'rising': [10, 11, 12, 13, 14, 20],
+        'exactly_15_percent': [100, 101, 102, 103, 104, 115],
+        'just_below_15_percent': [100, 101, 102, 103, 104, 114.99],
+        'zero_start': [0, 1, 2, 3, 4, 5],
+        'negative_start': [-10, -9, -8, -7, -6, -5],
+        'flat_day': [10, 11, 12, 12, 14, 20],
+        'nan_inside': [10, 11, np.nan, 13, 14, 20],
+        'nan_last': [10, 11, 12, 13, 14, np.nan],
+        'too_short': [10, 11, 12, 13, 20],
+        'older_dip': [50, 10, 11, 12, 13, 14, 20],
+    })
+    result = detected(df)
+    assert result == expected(df)
+    assert result['exactly_15_percent'] and result['zero_start'] and not result['too_short']
+
+
+def as_decimals(df):
+    # The same frame with Decimal moving averages, as psycopg2 returns a NUMERIC column
+    df = df.copy()
+    df['moving_average'] = [Decimal(repr(value)) for value in df['moving_average']]
+    return df
+
+
+def exact_rises(limit=7143):
+    # Two-decimal windows rising by exactly 15%: starts of whole cents where 1.15 x start is too
+    series = {}
+    for cents in range(40, 20 * (limit + 2), 20):
+        start = Decimal(cents) / 100
+        series[f'rise_{cents}'] = [start + Decimal('0.01') * day for day in range(5)] + [start * Decimal('1.15')]
+    return series
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_is_trending_on_random_decimal_videos(seed):
+    df = random_statistics(600, seed)
+    df = as_decimals(df[df['moving_average'].notna()])
+    assert detected(df) == expected(df)
+
+
+def test_exact_15_percent_rises_trend_with_decimals_and_floats():
+    df = statistics_for(exact_rises())
+    df['moving_average'] = df['moving_average'].astype(object)
+    assert detected(df) == expected(df)
+    assert all(detected(df).values())
+    # The compact loader casts NUMERIC to double precision; the re-check recovers the decimals
+    df['moving_average'] = df['moving_average'].astype(np.float64)
+    assert all(detected(df).values())
+
+
+def test_reviewed_decimal_example():
+    df = statistics_for({'rise': [Decimal(value) for value in ('1', '1.001', '1.002', '1.003', '1.004', '1.15')]})
+    assert detected(df) == expected(df) == {'rise': True}
+
+
+def test_decimal_values_equal_as_floats_are_compared_exactly():
+    df = statistics_for({
+        'tiny_steps': [Decimal('1'), Decimal('1.1'), Decimal('1.2'), Decimal('1.3'),
+                       Decimal('1.3000000000000000000001'), Decimal('1.4')],
+        'flat_day': [Decimal(value) for value in ('1', '1.1', '1.2', '1.2', '1.3', '1.4')],
+    })
+    assert detected(df) == expected(df) == {'tiny_steps': True, 'flat_day': False}
+
+
+def test_offsets_slice_each_video_back_out():
+    df = random_statistics(200, 7)
+    sorted_df, result = detect_trends(df)
+    for video_id, start, stop in zip(result['video_id'], result['start'], result['stop']):
+        group = sorted_df.iloc[start:stop]
+        assert (group['video_id'] == video_id).all()
+        assert group['date'].is_monotonic_increasing
+        assert len(group) == (df['video_id'] == video_id).sum()
+
+
+def test_unknown_detector_names_are_rejected():
+    assert parse_detectors(' zscore_spike, below_5_percent,') == ['zscore_spike', 'below_5_percent']
+    with pytest.raises(ValueError, match='bogus'):
+        parse_detectors('zscore_spike,bogus')
+    with pytest.raises(ValueError):
+        detect_trends(statistics_for({'rising': [1, 2, 3, 4, 5, 6]}), detectors=['bogus'])
+
+
+def test_below_5_percent_is_a_threshold_on_the_window_increase():
+    df = statistics_for({
+        'flat': [100, 100, 100, 100, 100, 100],
+        'just_under': [100, 101, 102, 103, 104, 104.99],
+        'at_threshold': [100, 101, 102, 103, 104, 105],
+        'too_short': [100, 100, 100, 100, 100],
+    })
+    _, result = detect_trends(df, detectors=['below_5_percent'])
+    assert dict(zip(result['video_id'], result['below_5_percent'].tolist())) == \
+        {'flat': True, 'just_under': True, 'at_threshold': False, 'too_short': False}
+
+
+def test_no_longer_trending_only_fires_for_tracked_videos():
+    df = statistics_for({
+        'tracked_cooling': [100, 100, 101, 101, 102, 102],
+        'tracked_still_rising': [100, 102, 104, 106, 108, 110],
+        'untracked_cooling': [100, 100, 101, 101, 102, 102],
+    })
+    _, result = detect_trends(df, detectors=['no_longer_trending'], tracked=['tracked_cooling', 'tracked_still_rising'])
+    assert dict(zip(result['video_id'], result['no_longer_trending'].tolist())) == \
+        {'tracked_cooling': True, 'tracked_still_rising': False, 'untracked_cooling': False}
+
+
+def test_detectors_window_covers_the_widest_rule():
+    assert detectors_window([]) == 6
+    assert detectors_window(['slope_7d', 'zscore_spike']) == 14
@@ -0,0 +1,60 @@
+import numpy as np
+from psycopg2.extras import execute_values
+
+
+# Same upsert as update_trending_videos_database, for many rows per statement
+UPSERT_QUERY = '''
+INSERT INTO current_trending_videos (video_id, last_moving_average, trend_status, last_alert_date, times_trended)
+VALUES %s
+ON CONFLICT (video_id) DO UPDATE
+SET last_moving_average = EXCLUDED.last_moving_average,
+    trend_status = EXCLUDED.trend_status,
+    last_alert_date = CURRENT_DATE,
+    times_trended = current_trending_videos.times_trended + CASE
+                        WHEN EXCLUDED.trend_status = current_trending_videos.trend_status THEN 0
+                        ELSE 1 END;
+'''
+UPSERT_TEMPLATE = '(%s, %s, %s, CURRENT_DATE, 1)'
+
+PAGE_SIZE = 1000
+
+
+def upsert_trend_state(cursor, rows, page_size=PAGE_SIZE):
+    # rows: (video_id, last_moving_average, trend_status) with unique video_ids;
+    # ON CONFLICT cannot touch the same row twice in one statement
+    if rows:
+        execute_values(cursor, UPSERT_QUERY, rows, template=UPSERT_TEMPLATE, page_size=page_size)
+
+
+class TrendStateWriter:
+    """
+    Collects the trend changes of a run and writes them in one transaction.
+
+    Later changes for the same video replace earlier ones, so each video is
+    upserted once.
+    """
+
+    def __init__(self):
+        self._changes = {}
+
+    def add(self, video_id, last_moving_average, trend_status):
+        # psycopg2 cannot adapt numpy scalars, so unwrap them to plain Python values
+        if isinstance(last_moving_average, np.generic):
+            last_moving_average = last_moving_average.item()
+        self._changes[video_id] = (video_id, last_moving_average, trend_status)
+
+    def __len__(self):
+        return len(self._changes)
+
+    def apply(self, cursor):
+        # Upsert every collected change and commit. Rolls back if anything fails.
+        # Videos that stop trending are removed by the --sweep run (check_previous_trends).
+        try:
+            upsert_trend_state(cursor, list(self._changes.values()))
+            cursor.connection.commit()
+        except Exception:
+            cursor.connection.rollback()
+            raise
+        applied = len(self._changes)
+        self._changes = {}
+        return applied
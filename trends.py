@@ -0,0 +1,230 @@
+from collections import namedtuple
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+
+# Number of rows the trend rule looks at: the most recent day plus the 5 before it
+TREND_WINDOW = 6
+MIN_INCREASE_PERCENTAGE = 15
+# Relative distance from the threshold within which a float64 percentage may fall on the wrong side of it
+THRESHOLD_TOLERANCE = 1e-9
+
+
+def sort_for_trends(df):
+    # Stable sort by video_id then date ascending, the same order is_trending expects per group
+    return df.sort_values(by=['video_id', 'date'], kind='mergesort').reset_index(drop=True)
+
+
+def group_bounds(video_ids):
+    # Return the start/stop row offsets of each run of equal video_ids in a sorted array
+    video_ids = np.asarray(video_ids)
+    n = len(video_ids)
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    change = np.flatnonzero(video_ids[1:] != video_ids[:-1]) + 1
+    starts = np.concatenate(([0], change)).astype(np.int64)
+    stops = np.concatenate((change, [n])).astype(np.int64)
+    return starts, stops
+
+
+def window_matrix(values, stops, counts, window):
+    # Gather the last `window` values of every group into a (n_groups, window) matrix.
+    # Groups shorter than the window are left-padded with NaN.
+    offsets = np.arange(-window, 0, dtype=np.int64)
+    idx = stops[:, None] + offsets[None, :]
+    short = offsets[None, :] < -counts[:, None]
+    matrix = values[np.where(short, 0, idx)]
+    matrix[short] = np.nan
+    return matrix
+
+
+def percentage_increase(matrix):
+    # Increase from the first to the last value of each window row, in percent
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (matrix[:, -1] - matrix[:, 0]) / matrix[:, 0] * 100
+
+
+def consistent_increase(matrix, counts, min_increase_percentage=MIN_INCREASE_PERCENTAGE):
+    # The is_trending rule: every day higher than the day before and a large enough overall increase
+    window = matrix.shape[1]
+    with np.errstate(invalid='ignore'):
+        is_consistently_increasing = np.all(matrix[:, :-1] < matrix[:, 1:], axis=1)
+        return (
+            (counts >= window)
+            & is_consistently_increasing
+            & (percentage_increase(matrix) >= min_increase_percentage)
+        )
+
+
+def exact_value(value):
+    # The decimal a moving average stands for: Decimals as they are, floats by their shortest
+    # repr, which gives back a NUMERIC value of up to 15 significant digits exactly
+    return value if isinstance(value, Decimal) else Decimal(repr(float(value)))
+
+
+def exact_consistent_increase(values, min_increase_percentage=MIN_INCREASE_PERCENTAGE):
+    # consistent_increase for one video's window, in Decimal arithmetic like is_trending on NUMERIC rows
+    values = [exact_value(value) for value in values]
+    start, end = values[0], values[-1]
+    is_consistently_increasing = all(a < b for a, b in zip(values[:-1], values[1:]))
+    if start == 0:
+        # numpy's division by zero: an increase from 0 is infinite
+        return is_consistently_increasing
+    return is_consistently_increasing and (end - start) / start * 100 >= exact_value(min_increase_percentage)
+
+
+def near_threshold(matrix, counts, min_increase_percentage=MIN_INCREASE_PERCENTAGE, ties=False):
+    # Rows where float64 may disagree with exact decimal arithmetic: consistently increasing with an
+    # increase within THRESHOLD_TOLERANCE of the threshold, or with ties=True (Decimal input) also
+    # neighbours that are equal as floats but may differ beyond float precision
+    with np.errstate(invalid='ignore'):
+        increasing = np.all(matrix[:, :-1] < matrix[:, 1:], axis=1)
+        close = (np.abs(percentage_increase(matrix) - min_increase_percentage)
+                 <= THRESHOLD_TOLERANCE * max(abs(min_increase_percentage), 1))
+        recheck = increasing & close
+        if ties:
+            recheck |= ~increasing & np.all(matrix[:, :-1] <= matrix[:, 1:], axis=1)
+        return (counts >= matrix.shape[1]) & (matrix[:, 0] != 0) & recheck
+
+
+def zscore_spike(matrix, counts, min_zscore=3.0):
+    # Latest value far above the mean of the days before it
+    history = matrix[:, :-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zscore = (matrix[:, -1] - history.mean(axis=1)) / history.std(axis=1)
+        return (counts >= matrix.shape[1]) & (zscore >= min_zscore)
+
+
+def slope_increase(matrix, counts, min_daily_percentage=5.0):
+    # Least-squares slope over the window, as a percentage of the window mean per day
+    x = np.arange(matrix.shape[1], dtype=np.float64)
+    x -= x.mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (matrix - matrix.mean(axis=1, keepdims=True)) @ x / (x @ x)
+        return (counts >= matrix.shape[1]) & (slope / matrix.mean(axis=1) * 100 >= min_daily_percentage)
+
+
+def below_increase_threshold(matrix, counts, max_increase_percentage=5.0):
+    # Increase over the window below max_increase_percentage. A stateless threshold, not
+    # hysteresis: it ignores whether the video was trending before, so callers that want an
+    # exit rule combine it with the tracked state in current_trending_videos
+    with np.errstate(invalid='ignore'):
+        return (counts >= matrix.shape[1]) & ~(percentage_increase(matrix) >= max_increase_percentage)
+
+
+def exit_below_threshold(matrix, counts, was_trending, exit_percentage=5.0):
+    # "No longer trending" with hysteresis: a tracked video only drops out once its increase
+    # over the window falls below exit_percentage, well under the 15% it needed to get in.
+    # was_trending marks the videos tracked in current_trending_videos before this run.
+    return was_trending & below_increase_threshold(matrix, counts, exit_percentage)
+
+Detector = namedtuple('Detector', ['name', 'func', 'window', 'stateful', 'params'])
+
+# Detectors that detect_trends can run alongside the main rule, by name
+DETECTORS = {}
+
+
+def register_detector(name, func, window, stateful=False, **params):
+    """
+    Register a trend rule under `name`.
+
+    func(matrix, counts, **params) gets the last `window` moving averages of every
+    video as a (n_videos, window) matrix, oldest first and left-padded with NaN for
+    videos with fewer rows, plus each video's row count. It returns a boolean array.
+    A stateful rule is called as func(matrix, counts, was_trending, **params), where
+    was_trending marks the videos in detect_trends' `tracked` ids, e.g. the ones in
+    current_trending_videos, so it can apply hysteresis.
+    """
+    DETECTORS[name] = Detector(name, func, window, stateful, params)
+
+
+def check_detectors(names):
+    # The names, after checking each is registered; unknown names raise ValueError
+    unknown = [name for name in names if name not in DETECTORS]
+    if unknown:
+        raise ValueError(f"Unknown trend detectors {', '.join(unknown)}; "
+                         f"registered detectors are {', '.join(sorted(DETECTORS))}")
+    return list(names)
+
+
+def parse_detectors(value):
+    # Comma separated detector names, e.g. the TREND_DETECTORS setting
+    return check_detectors([name.strip() for name in value.split(',') if name.strip()])
+
+
+def detectors_window(names, window=TREND_WINDOW):
+    # Rows per video needed to evaluate the main rule and every named detector
+    return max([window] + [DETECTORS[name].window for name in check_detectors(names)])
+
+
+def stateful_detectors(names):
+    # True when any named detector needs the tracked video ids
+    return any(DETECTORS[name].stateful for name in check_detectors(names))
+
+
+register_detector('trending', consistent_increase, TREND_WINDOW, min_increase_percentage=MIN_INCREASE_PERCENTAGE)
+register_detector('zscore_spike', zscore_spike, 14, min_zscore=3.0)
+register_detector('slope_7d', slope_increase, 7, min_daily_percentage=5.0)
+register_detector('below_5_percent', below_increase_threshold, TREND_WINDOW, max_increase_percentage=5.0)
+register_detector('no_longer_trending', exit_below_threshold, TREND_WINDOW, stateful=True, exit_percentage=5.0)
+
+
+def detect_trends(df, min_increase_percentage=MIN_INCREASE_PERCENTAGE, window=TREND_WINDOW, presorted=False,
+                  detectors=(), tracked=()):
+    """
+    Evaluate the trend rule for every video in one vectorized pass.
+
+    Gives the same answer as running is_trending on each video's group sorted by date,
+    with NUMERIC values as Decimal. Values are compared as float64, and the few videos
+    float64 cannot decide (an increase right at the threshold, or equal neighbours in
+    Decimal input) are checked again with exact_consistent_increase.
+    Returns one row per video with the start/stop offsets of its rows in the sorted frame,
+    so callers can slice a group back out with sorted_df.iloc[start:stop].
+    Each name in `detectors` adds a boolean column with that registered rule's result;
+    all rules share one window matrix as wide as the largest window. Stateful rules
+    see which videos are in `tracked`.
+    Returns (sorted_df, result).
+    """
+    sorted_df = df if presorted else sort_for_trends(df)
+    video_ids = sorted_df['video_id'].to_numpy()
+    moving_averages = sorted_df['moving_average']
+    values = moving_averages.to_numpy(dtype=np.float64, na_value=np.nan)
+
+    starts, stops = group_bounds(video_ids)
+    counts = stops - starts
+    rules = [DETECTORS[name] for name in check_detectors(detectors)]
+    widest = max([window] + [rule.window for rule in rules])
+    shared = window_matrix(values, stops, counts, widest)
+    matrix = shared[:, widest - window:]
+
+    trending = consistent_increase(matrix, counts, min_increase_percentage)
+    recheck = near_threshold(matrix, counts, min_increase_percentage, ties=moving_averages.dtype == object)
+    if recheck.any():
+        originals = moving_averages.to_numpy()
+        trending[recheck] = [exact_consistent_increase(originals[stop - window:stop], min_increase_percentage)
+                             for stop in stops[recheck]]
+
+    result = pd.DataFrame({
+        'video_id': video_ids[starts],
+        'start': starts,
+        'stop': stops,
+        'rows': counts,
+        'start_average': matrix[:, 0],
+        'end_average': matrix[:, -1],
+        'percentage_increase': percentage_increase(matrix),
+        'is_trending': trending,
+    })
+    was_trending = None
+    for rule in rules:
+        rule_matrix = shared[:, widest - rule.window:]
+        if rule.stateful:
+            if was_trending is None:
+                was_trending = np.isin(result['video_id'].to_numpy(dtype=object), list(tracked))
+            result[rule.name] = rule.func(rule_matrix, counts, was_trending, **rule.params)
+        else:
+            result[rule.name] = rule.func(rule_matrix, counts, **rule.params)
+    return sorted_df, result
+